@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+
+import fusionengine as fusion
+from coalescer import CoalescingSession
+from fairqueue import CLASS_WEIGHTS, DEFAULT_CLASS, FairQueue
+from fusionsession import FusionSession
+from loadbalancer import LoadBalancer, parse_endpoint
+from preprocess import FORMATS, PreprocessOptions, Preprocessor
+from inputcache import DEFAULT_MAX_BYTES, DEFAULT_SPILL_MAX_BYTES, EncodedInputCache
+from jobjournal import JobJournal
+from outputformat import OUTPUT_FORMATS, OutputFormat, Transcoder
+from resultcache import ResultCache
+from retrypolicy import HEDGE_BUDGET, HEDGE_QUANTILE, MAX_ATTEMPTS, RETRYABLE_ERRORS, HedgedSession, RetryPolicy
+from scheduler import AdaptiveLimiter, AdaptiveScheduler
+from telemetry import Telemetry
+from uploadrefs import UploadReferenceCache
+
+# Number of /queue/join sessions kept in flight at once
+DEFAULT_CONCURRENCY = 4
+
+
+def read_manifest(path):
+    # Read jobs from a JSONL file (one object per line) or a CSV file with a header row.
+    # Each job needs "source" and "target"; "output" defaults to <target name>_fused.png.
+    # Optional "priority" (a fairqueue class), "tenant" and "deadline" (seconds from the start of
+    # the run) are used with --fair.
+    jobs = []
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for index, row in enumerate(rows):
+            source = (row.get('source') or '').strip()
+            target = (row.get('target') or '').strip()
+            if not source or not target:
+                raise ValueError(f"Manifest row {index + 1} needs both 'source' and 'target'.")
+            output = (row.get('output') or '').strip()
+            if not output:
+                output = os.path.splitext(target)[0] + '_fused.png'
+            job = {"source": source, "target": target, "output": output}
+            priority = (row.get('priority') or '').strip()
+            if priority:
+                if priority not in CLASS_WEIGHTS:
+                    raise ValueError(f"Manifest row {index + 1} has unknown priority {priority!r}.")
+                job['priority'] = priority
+            tenant = str(row.get('tenant') or '').strip()
+            if tenant:
+                job['tenant'] = tenant
+            deadline = str(row.get('deadline') or '').strip()
+            if deadline:
+                job['deadline'] = float(deadline)
+            jobs.append(job)
+    return jobs
+
+
+def summarize_timings(results):
+    # Mean seconds per phase over jobs that actually went to the server
+    totals, counts = {}, {}
+    for result in results:
+        if result.get('cached'):
+            continue
+        for phase, seconds in (result.get('timings') or {}).items():
+            totals[phase] = totals.get(phase, 0.0) + seconds
+            counts[phase] = counts.get(phase, 0) + 1
+    return {phase: round(totals[phase] / counts[phase], 4) for phase in totals}
+
+
+async def run_batch_async(jobs, session, concurrency=DEFAULT_CONCURRENCY, results_path=None, scheduler=None,
+                          metrics_port=None, journal=None, retry_policy=None):
+    # Run every job through one FusionSession, so cookies, pooled connections and caches are shared.
+    # The semaphore bounds the number of /queue/join sessions in flight on the event loop; with an
+    # AdaptiveScheduler the bound follows the server's queue signals instead.
+    # With metrics_port, the session's telemetry is served on /metrics while the batch runs.
+    # With journal (a JobJournal), every state change is recorded so an interrupted run can resume.
+    # With retry_policy (a RetryPolicy), retryable failures go back through the semaphore or scheduler.
+    # A FairQueue scheduler lets jobs through by their priority, tenant and deadline.
+    limit = asyncio.Semaphore(concurrency)
+    results = []
+    results_file = open(results_path, 'a') if results_path else None
+
+    async def attempt_job(job):
+        on_state = None
+        if journal is not None:
+            on_state = lambda state: journal.record(job, state)
+        try:
+            if isinstance(session, CoalescingSession):
+                # Only the job that goes to the server takes a slot; identical jobs just wait on it
+                return await session.fuse(job['source'], job['target'], job['output'], check_cache=False,
+                                          admit=lambda run: admit(job, run), on_state=on_state)
+            return await admit(job, lambda on_estimation: session.fuse(
+                job['source'], job['target'], job['output'], check_cache=False,
+                on_estimation=on_estimation, on_state=on_state))
+        except Exception as e:
+            return dict(job, status="failed", error=f"{type(e).__name__}: {e}", elapsed=None)
+
+    async def run_job(job):
+        result = await run_one(job)
+        if journal is not None:
+            journal.finish(job, result)
+        return result
+
+    async def run_one(job):
+        # Missing inputs fail the job rather than the whole batch
+        for key in ('source', 'target'):
+            if not os.path.isfile(job[key]):
+                return dict(job, status="failed", error=f"Image file {job[key]} does not exist.", elapsed=0.0)
+        output_dir = os.path.dirname(job['output'])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        # Replayed jobs are served from the result cache without taking a queue slot
+        cached = await session.restore_cached(job['source'], job['target'], job['output'])
+        if cached is not None:
+            return cached
+        if retry_policy is not None:
+            return await retry_policy.run(lambda: attempt_job(job))
+        return await attempt_job(job)
+
+    async def admit(job, run):
+        # Run run(on_estimation) once the fair queue, scheduler or semaphore has a slot for it
+        if isinstance(scheduler, FairQueue):
+            # Deadlines count from the start of the run, so each retry gets only what is left
+            deadline = job.get('deadline')
+            remaining = None if deadline is None else deadline - (time.monotonic() - started)
+            return await scheduler.submit(run, job.get('priority'), job.get('tenant'), remaining, record=job)
+        if scheduler is not None:
+            return await scheduler.submit(run)
+        async with limit:
+            return await run(None)
+
+    telemetry = getattr(session, 'telemetry', None)
+    if telemetry is not None and isinstance(scheduler, FairQueue):
+        telemetry.attach_queue(scheduler)
+    if telemetry is not None and metrics_port:
+        await telemetry.serve(port=metrics_port)
+    started = time.monotonic()
+    try:
+        async with session:
+            # Bootstrap up front so an unreachable server fails the batch immediately
+            await session.ensure_cookies()
+            tasks = [asyncio.create_task(run_job(job)) for job in jobs]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    result = await task
+                    results.append(result)
+                    if results_file:
+                        results_file.write(json.dumps(result) + '\n')
+                        results_file.flush()
+                    print(f"[{len(results)}/{len(jobs)}] {result['status']}: {result['target']} -> {result['output']}"
+                          + (f" ({result['error']})" if result['error'] else ""))
+            finally:
+                # On interrupt, cancel in-flight jobs before the session closes under them, so they
+                # stay in flight in the journal (and are re-queued) instead of failing
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if results_file:
+            results_file.close()
+        if telemetry is not None:
+            await telemetry.stop_serving()
+
+    elapsed = time.monotonic() - started
+    done = sum(1 for result in results if result['status'] == 'done')
+    print(f"Completed {done}/{len(jobs)} jobs in {elapsed:.1f}s "
+          f"({len(jobs) / elapsed if elapsed else 0:.2f} jobs/s, concurrency {concurrency}).")
+    print(f"Mean seconds per phase: {json.dumps(summarize_timings(results))} "
+          f"({session.bootstraps} bootstrap request(s))")
+    if isinstance(session, CoalescingSession):
+        print(f"Coalescing: {json.dumps(session.stats())}")
+        session = session.session
+    if isinstance(session, HedgedSession):
+        print(f"Hedging: {json.dumps(session.stats())}")
+    if isinstance(getattr(session, 'primary', session), LoadBalancer):
+        print(f"Endpoints: {json.dumps(getattr(session, 'primary', session).stats())}")
+    if retry_policy is not None:
+        print(f"Retries: {json.dumps(retry_policy.stats())}")
+    if scheduler is not None:
+        print(f"Scheduler: {json.dumps(scheduler.stats())}")
+    if getattr(session, 'preprocessor', None) is not None:
+        print(f"Pre-processing: {json.dumps(session.preprocessor.stats())}")
+    if getattr(session, 'transcoder', None) is not None:
+        print(f"Outputs: {json.dumps(session.transcoder.stats())}")
+    if session.input_cache is not None:
+        print(f"Input cache: {json.dumps(session.input_cache.stats())}")
+    if session.upload_refs is not None:
+        print(f"Uploads: {json.dumps(session.upload_refs.stats())}")
+    if session.result_cache is not None:
+        print(f"Result cache: {json.dumps(session.result_cache.stats())}")
+    return results
+
+
+def run_batch(jobs, session, **kwargs):
+    return asyncio.run(run_batch_async(jobs, session, **kwargs))
+
+
+def add_session_arguments(parser):
+    # Options shared by every CLI that builds a session with build_session()
+    parser.add_argument('--app-url', default=fusion.APP_URL, help="Defaults to $APP_URL")
+    parser.add_argument('--websocket-url', default=fusion.WEBSOCKET_URL, help="Defaults to $WEBSOCKET_URL")
+    parser.add_argument('--endpoint', action='append', default=[],
+                        help="APP_URL[,WEBSOCKET_URL] of a backend; repeat to balance over several "
+                             "(defaults to the comma-separated $APP_URLS)")
+    parser.add_argument('--max-size', type=int, help="Downscale inputs so the longest side is at most this")
+    parser.add_argument('--crop-face', action='store_true', help="Crop source images to the detected face")
+    parser.add_argument('--reencode', choices=sorted(FORMATS), help="Re-encode inputs to this format")
+    parser.add_argument('--quality', type=int, default=90, help="JPEG/WebP quality when re-encoding")
+    parser.add_argument('--preprocess-workers', type=int,
+                        help="Processes for the pre-processing and transcoding stages")
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS),
+                        help="Store outputs in this format, transcoding on receipt when the server sends another")
+    parser.add_argument('--output-quality', type=int,
+                        help="JPEG/WebP output quality (default: lossless WebP, JPEG quality 90)")
+    parser.add_argument('--compress', action='store_true',
+                        help="Offer permessage-deflate on the queue WebSocket: about a quarter fewer bytes each way "
+                             "for several times the client CPU, so only worth it on slow links")
+    parser.add_argument('--fn-index', type=int, default=fusion.FN_INDEX)
+    parser.add_argument('--timeout', type=float, default=fusion.PROCESS_TIMEOUT,
+                        help="Seconds allowed between process_starts and process_completed")
+    parser.add_argument('--connect-timeout', type=float, default=fusion.CONNECT_TIMEOUT,
+                        help="Seconds allowed for the WebSocket handshake")
+    parser.add_argument('--queue-timeout', type=float,
+                        help="Seconds allowed from joining the queue to process_starts (default: no limit)")
+    parser.add_argument('--eta-scale', type=float,
+                        help="Scale the queue and processing deadlines to this multiple of the server's estimates")
+    parser.add_argument('--attempts', type=int, default=MAX_ATTEMPTS,
+                        help="Attempts per job for retryable failures, with jittered exponential backoff")
+    parser.add_argument('--hedge', action='store_true',
+                        help="Resubmit straggler jobs to a second session and keep whichever finishes first")
+    parser.add_argument('--hedge-quantile', type=float, default=HEDGE_QUANTILE,
+                        help="Hedge jobs running longer than this quantile of recent job latencies")
+    parser.add_argument('--hedge-budget', type=float, default=HEDGE_BUDGET,
+                        help="Hedge at most this fraction of jobs")
+    parser.add_argument('--coalesce', action='store_true',
+                        help="Share one queue job between identical submissions in flight at the same time")
+    parser.add_argument('--input-cache-mb', type=float, default=DEFAULT_MAX_BYTES / 2 ** 20,
+                        help="Memory budget for encoded inputs (0 disables the cache)")
+    parser.add_argument('--input-cache-dir', help="Spill encoded inputs here so restarts start warm")
+    parser.add_argument('--input-cache-dir-mb', type=float, default=DEFAULT_SPILL_MAX_BYTES / 2 ** 20,
+                        help="Size cap for --input-cache-dir; least recently used inputs are removed")
+    parser.add_argument('--upload', action='store_true',
+                        help="Upload each distinct input once via /upload and send file references")
+    parser.add_argument('--upload-refs', help="JSON file persisting uploaded references between runs")
+    parser.add_argument('--result-cache', help="Directory of fused outputs reused for repeated pairs")
+    parser.add_argument('--result-cache-mb', type=float, default=1024, help="Size cap for the result cache")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this port")
+    parser.add_argument('--metrics-file', help="Write Prometheus metrics here on exit")
+    parser.add_argument('--trace-file', help="Append one OTLP/JSON trace per job to this file")
+    parser.add_argument('--log-level', default='WARNING', help="DEBUG logs every queue message (never payloads)")
+
+
+def build_session(parser, args, upload_refs_path=None):
+    # Build the session (FusionSession, LoadBalancer, optionally hedged) and its caches from the
+    # add_session_arguments() options; release it with release_session()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    endpoints = [parse_endpoint(value) for value in args.endpoint]
+    if not endpoints and os.getenv('APP_URLS'):
+        endpoints = [parse_endpoint(value) for value in os.getenv('APP_URLS').split(',') if value.strip()]
+    if not endpoints and (not args.app_url or not args.websocket_url):
+        parser.error("Set APP_URL and WEBSOCKET_URL or pass --app-url and --websocket-url (or --endpoint).")
+
+    input_cache = None
+    if args.input_cache_mb > 0:
+        input_cache = EncodedInputCache(int(args.input_cache_mb * 2 ** 20), spill_dir=args.input_cache_dir,
+                                        spill_max_bytes=int(args.input_cache_dir_mb * 2 ** 20))
+
+    upload_refs = None
+    if args.upload:
+        upload_refs = UploadReferenceCache(args.upload_refs or upload_refs_path)
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache, int(args.result_cache_mb * 2 ** 20))
+
+    preprocessor = None
+    preprocess_options = PreprocessOptions(max_size=args.max_size, crop_face=args.crop_face,
+                                           format=args.reencode, quality=args.quality)
+    if preprocess_options.enabled():
+        preprocessor = Preprocessor(preprocess_options, workers=args.preprocess_workers)
+
+    transcoder = None
+    if args.output_format:
+        quality = args.output_quality
+        if quality is None and args.output_format == 'jpeg':
+            quality = 90
+        transcoder = Transcoder(OutputFormat(args.output_format, quality), workers=args.preprocess_workers)
+
+    telemetry = None
+    if args.metrics_port or args.metrics_file or args.trace_file:
+        telemetry = Telemetry(trace_path=args.trace_file)
+
+    session_options = dict(
+        concurrency=args.concurrency, fn_index=args.fn_index, process_timeout=args.timeout,
+        connect_timeout=args.connect_timeout, queue_timeout=args.queue_timeout, eta_scale=args.eta_scale,
+        input_cache=input_cache, upload_refs=upload_refs, result_cache=result_cache, preprocessor=preprocessor,
+        telemetry=telemetry, compress=fusion.WS_COMPRESS if args.compress else 0, transcoder=transcoder)
+    if endpoints:
+        session = LoadBalancer(endpoints, **session_options)
+    else:
+        session = FusionSession(args.app_url, args.websocket_url, **session_options)
+    if args.hedge:
+        # Hedges go to a second session with its own cookies and connection pool; a load balancer
+        # already spreads them over its endpoints
+        secondary = session
+        if not endpoints:
+            secondary = FusionSession(args.app_url, args.websocket_url, **session_options)
+        session = HedgedSession(session, secondary, quantile=args.hedge_quantile, budget=args.hedge_budget)
+    if args.coalesce:
+        session = CoalescingSession(session)
+    return session
+
+
+def release_session(session, args):
+    # Stop the pre-processing and transcoding pools and flush telemetry; the session itself is
+    # closed by its context
+    if session.preprocessor is not None:
+        session.preprocessor.close()
+    if session.transcoder is not None:
+        session.transcoder.close()
+    if session.telemetry is not None:
+        if args.metrics_file:
+            session.telemetry.write_metrics(args.metrics_file)
+        session.telemetry.close()
+
+
+def parse_weights(parser, values):
+    # NAME=WEIGHT pairs from the command line
+    weights = {}
+    for value in values:
+        name, _, weight = value.rpartition('=')
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            name = ''
+        if not name or weights[name] <= 0:
+            parser.error(f"Expected NAME=WEIGHT with a positive weight, got {value!r}.")
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuse many source/target pairs over concurrent queue sessions.")
+    parser.add_argument('manifest', help="CSV (source,target,output) or JSONL manifest of jobs")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of queue sessions kept in flight (the upper bound with --adaptive)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Adapt concurrency to rank_eta/queue_full and retry queue_full with backoff")
+    parser.add_argument('--target-queue-delay', type=float, default=5.0,
+                        help="With --adaptive, ramp up while rank_eta stays below this many seconds")
+    parser.add_argument('--fair', action='store_true',
+                        help="Let jobs through by priority class, per-tenant weighted fair share and deadline")
+    parser.add_argument('--priority', choices=sorted(CLASS_WEIGHTS), default=DEFAULT_CLASS,
+                        help="With --fair, the class of jobs whose manifest row sets none")
+    parser.add_argument('--tenant-weight', action='append', default=[], metavar='TENANT=WEIGHT',
+                        help="With --fair, a tenant's share relative to others in its class (default 1)")
+    parser.add_argument('--results', default='batch_results.jsonl', help="Per-job result records (JSONL)")
+    parser.add_argument('--journal', help="SQLite journal of job states; rerunning with it resumes unfinished jobs")
+    parser.add_argument('--skip-failed', action='store_true', help="When resuming, do not retry failed jobs")
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    # A resumable run keeps its uploaded references next to the journal unless told otherwise
+    session = build_session(parser, args, upload_refs_path=args.journal + '.uploads.json' if args.journal else None)
+
+    scheduler = None
+    limiter = None
+    if args.adaptive:
+        limiter = AdaptiveLimiter(initial=min(4, args.concurrency), maximum=args.concurrency,
+                                  target_queue_delay=args.target_queue_delay)
+        scheduler = AdaptiveScheduler(limiter)
+    if args.fair:
+        scheduler = FairQueue(args.concurrency, limiter=limiter,
+                              tenant_weights=parse_weights(parser, args.tenant_weight))
+    retry_policy = None
+    if args.attempts > 1:
+        # With --adaptive the scheduler already backs off and resubmits on queue_full
+        retryable = RETRYABLE_ERRORS - {'queue_full'} if limiter is not None else RETRYABLE_ERRORS
+        retry_policy = RetryPolicy(max_attempts=args.attempts, retryable=retryable)
+
+    jobs = read_manifest(args.manifest)
+    if args.fair:
+        for job in jobs:
+            job.setdefault('priority', args.priority)
+    journal = None
+    if args.journal:
+        journal = JobJournal(args.journal)
+        total = len(jobs)
+        jobs = journal.pending(jobs, retry_failed=not args.skip_failed)
+        print(f"Journal: {total - len(jobs)} of {total} jobs already finished; running {len(jobs)}.")
+    try:
+        results = run_batch(jobs, session, concurrency=args.concurrency, results_path=args.results,
+                            scheduler=scheduler, metrics_port=args.metrics_port, journal=journal,
+                            retry_policy=retry_policy)
+    except KeyboardInterrupt:
+        # Finished jobs are already journaled; in-flight ones are re-queued on the next run
+        print("Interrupted; rerun with the same --journal to resume.")
+        exit(130)
+    finally:
+        if journal is not None:
+            journal.close()
+        release_session(session, args)
+    if any(result['status'] != 'done' for result in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from payloadencoding import EncodedInput, build_data_frame
+
+# Peak RSS per job for building the send_data frame, before (str-based) and after (buffer-based).
+# Each mode runs in a fresh interpreter so ru_maxrss reflects only that mode.
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def legacy_frame(source_path, target_path):
+    # The original approach: read, base64 to str, concatenate, json.dumps, then encode for the socket
+    with open(source_path, 'rb') as f:
+        image1_data = f.read()
+        image1_b64 = "data:image/jpeg;base64," + base64.b64encode(image1_data).decode('utf-8')
+    with open(target_path, 'rb') as f:
+        image2_data = f.read()
+        image2_b64 = "data:image/jpeg;base64," + base64.b64encode(image2_data).decode('utf-8')
+    payload = {
+        "fn_index": 105,
+        "data": [image1_b64, image2_b64, None],
+        "event_data": None,
+        "session_hash": "0123456789abcdef",
+        "session_id": "",
+        "msg": "data"
+    }
+    return json.dumps(payload).encode('utf-8')
+
+
+def streaming_frame(source_path, target_path):
+    inputs = [EncodedInput.from_path(source_path), EncodedInput.from_path(target_path), None]
+    return build_data_frame(inputs, 105, "0123456789abcdef", "")
+
+
+def run_mode(mode, source_path, target_path):
+    build = legacy_frame if mode == 'legacy' else streaming_frame
+    baseline = peak_rss_mb()
+    frame = build(source_path, target_path)
+    print(json.dumps({"mode": mode, "frame_mb": round(len(frame) / 2 ** 20, 2),
+                      "peak_rss_delta_mb": round(peak_rss_mb() - baseline, 2)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS per job for send_data frame construction.")
+    parser.add_argument('--size-mb', type=float, default=32, help="Size of each synthetic input image")
+    parser.add_argument('--mode', choices=['legacy', 'streaming'], help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    parser.add_argument('--target', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.source, args.target)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name in ('source.jpg', 'target.jpg'):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(int(args.size_mb * 2 ** 20)))
+            paths.append(path)
+
+        print(f"Two inputs of {args.size_mb} MB each")
+        for mode in ('legacy', 'streaming'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--mode', mode, '--source', paths[0], '--target', paths[1]],
+                check=True, capture_output=True, text=True).stdout
+            record = json.loads(output)
+            print(f"{mode:>10}: frame {record['frame_mb']} MB, peak RSS +{record['peak_rss_delta_mb']} MB per job")
+
+
+if __name__ == "__main__":
+    main()
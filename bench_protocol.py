@@ -0,0 +1,114 @@
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import protocol
+
+# Messages/sec and allocations per message for dispatching /queue/join frames, before (json.loads
+# of every frame and an if/elif chain on "msg") and after (protocol.message_type, a handler table,
+# and parse_message keeping the output image as a span of the frame).
+
+
+def sample_messages(output_mb):
+    image = b'\x89PNG\r\n\x1a\n' + os.urandom(int(output_mb * 2 ** 20))
+    data_url = "data:image/png;base64," + base64.b64encode(image).decode('ascii')
+    return {
+        "send_hash": json.dumps({"msg": "send_hash"}),
+        "estimation": json.dumps({"msg": "estimation", "rank": 3, "queue_size": 12, "rank_eta": 4.2,
+                                  "avg_event_process_time": 1.1, "avg_event_concurrent_process_time": 0.4}),
+        "process_starts": json.dumps({"msg": "process_starts"}),
+        "process_completed": json.dumps({"msg": "process_completed", "success": True,
+                                         "output": {"data": [data_url], "is_generating": False, "duration": 1.2,
+                                                    "average_duration": 1.3}}),
+    }
+
+
+def legacy_dispatch(text):
+    # The original on_message: parse everything, then walk the chain
+    data = json.loads(text)
+    msg_type = data.get('msg')
+    if msg_type == 'send_hash':
+        return None
+    elif msg_type == 'estimation':
+        return data.get('rank_eta')
+    elif msg_type == 'send_data':
+        return None
+    elif msg_type == 'process_starts':
+        return None
+    elif msg_type == 'process_completed':
+        return data['output']['data'][0]
+    elif msg_type == 'queue_full':
+        return None
+    return None
+
+
+def on_estimation(text):
+    return protocol.loads(text).get('rank_eta')
+
+
+def on_completed(text):
+    return protocol.parse_message(text)['output']['data'][0]
+
+
+def skip(text):
+    return None
+
+
+HANDLERS = {"send_hash": skip, "estimation": on_estimation, "send_data": skip, "process_starts": skip,
+            "process_completed": on_completed, "queue_full": skip}
+
+
+def table_dispatch(text):
+    handler = HANDLERS.get(protocol.message_type(text))
+    return handler(text) if handler is not None else None
+
+
+def measure(dispatch, text, seconds):
+    # Messages per second over a fixed time budget
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(10):
+            dispatch(text)
+        count += 10
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - started)
+
+
+def allocations(dispatch, text):
+    # Peak bytes allocated while handling one message, and memory blocks still held by its result
+    dispatch(text)  # Warm caches so one-time allocations are not counted
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    result = dispatch(text)
+    blocks = sys.getallocatedblocks() - blocks_before
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of queue message parsing and dispatch.")
+    parser.add_argument('--output-mb', type=float, default=4, help="Size of the image in process_completed")
+    parser.add_argument('--seconds', type=float, default=1.0, help="Time budget per measurement")
+    args = parser.parse_args()
+
+    print(f"JSON backend: {'orjson' if protocol.orjson is not None else 'json'}; "
+          f"process_completed carries a {args.output_mb} MB image")
+    for name, text in sample_messages(args.output_mb).items():
+        for label, dispatch in (('legacy', legacy_dispatch), ('table', table_dispatch)):
+            rate = measure(dispatch, text, args.seconds)
+            peak, blocks = allocations(dispatch, text)
+            print(f"{name:>17} {label:>6}: {rate:>12,.0f} msg/s, peak {peak / 1024:>10,.1f} KiB, "
+                  f"{blocks:>4} blocks held")
+
+
+if __name__ == "__main__":
+    main()
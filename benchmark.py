@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+import fusionengine
+from fusionsession import FusionSession
+from outputformat import OUTPUT_FORMATS, OutputFormat, Transcoder
+from scheduler import AdaptiveLimiter, AdaptiveScheduler
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# End-to-end client benchmark against a local mockgradioserver.py, so regressions are caught without
+# GPU pods. Reports jobs/sec, latency percentiles, peak RSS and CPU per job for this process only
+# (the mock server runs in its own subprocess), and bytes per job on the wire, counted by a TCP
+# relay between client and server so compression shows up as it would on the proxy.
+# --compare runs an uncompressed, PNG-output baseline first and reports the change against it.
+
+SERVER_START_TIMEOUT = 15
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_input(path, size):
+    # A PNG signature followed by random bytes: the client only sniffs and encodes it
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(max(0, size - 8)))
+
+
+def write_image(path, side):
+    # A real PNG (gradients plus sensor-like noise) for runs that transcode outputs; the mock
+    # echoes the target, so outputs are real images too
+    gradient = Image.linear_gradient('L').resize((side, side))
+    noise = Image.effect_noise((side, side), 24)
+    Image.merge('RGB', (gradient, noise, gradient.rotate(90))).save(path, format='PNG')
+
+
+class WireCounter:
+    # TCP relay in front of the mock server counting the bytes each way. With bandwidth (bytes per
+    # second, each way) it also paces the traffic like a slow proxy link, so the latency cost of
+    # compression is weighed against the transfer time it saves.
+    def __init__(self, target_port, bandwidth=None):
+        self.target_port = target_port
+        self.bandwidth = bandwidth
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.link_free_at = {"bytes_up": 0.0, "bytes_down": 0.0}
+        self.server = None
+        self.relays = set()
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.relay, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def transmit(self, direction, size):
+        # Wait until the shared link has carried size more bytes in this direction
+        if not self.bandwidth:
+            return
+        now = asyncio.get_running_loop().time()
+        self.link_free_at[direction] = max(now, self.link_free_at[direction]) + size / self.bandwidth
+        await asyncio.sleep(self.link_free_at[direction] - now)
+
+    async def relay(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        except OSError:
+            client_writer.close()
+            return
+
+        async def pipe(reader, writer, direction):
+            try:
+                while chunk := await reader.read(2 ** 16):
+                    setattr(self, direction, getattr(self, direction) + len(chunk))
+                    await self.transmit(direction, len(chunk))
+                    writer.write(chunk)
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        task = asyncio.current_task()
+        self.relays.add(task)
+        self.writers.update((client_writer, server_writer))
+        try:
+            await asyncio.gather(pipe(client_reader, server_writer, 'bytes_up'),
+                                 pipe(server_reader, client_writer, 'bytes_down'))
+        finally:
+            self.relays.discard(task)
+            self.writers.difference_update((client_writer, server_writer))
+
+    async def close(self):
+        # Close kept-alive connections too, so their relays end before the loop does
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.gather(*self.relays, return_exceptions=True)
+
+
+def start_server(port, args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mockgradioserver.py'),
+               '--port', str(port), '--latency', str(args.latency), '--latency-jitter', str(args.latency_jitter),
+               '--output-mode', args.output_mode, '--error-rate', str(args.error_rate),
+               '--queue-full-rate', str(args.queue_full_rate), '--drop-rate', str(args.drop_rate),
+               '--stall-rate', str(args.stall_rate)]
+    for flag, value in (('--workers', args.workers), ('--capacity', args.capacity),
+                        ('--output-size', args.output_size), ('--seed', args.seed)):
+        if value is not None:
+            command += [flag, str(value)]
+    if args.server_no_compress:
+        command.append('--no-compress')
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_server(app_url, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Mock server exited with code {process.returncode}")
+            try:
+                async with http.get(app_url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Mock server did not start in time")
+
+
+async def fetch_server_stats(app_url):
+    try:
+        async with aiohttp.ClientSession() as http:
+            async with http.get(app_url + 'stats') as response:
+                return await response.json()
+    except aiohttp.ClientError:
+        return None
+
+
+async def run_jobs(session, jobs, concurrency, scheduler):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+    sizes = {"output_bytes": 0, "compressed_jobs": 0}
+
+    async def run_one(source, target, output):
+        started = time.monotonic()
+        if scheduler is not None:
+            result = await scheduler.submit(
+                lambda on_estimation: session.fuse(source, target, output, on_estimation=on_estimation))
+        else:
+            async with semaphore:
+                result = await session.fuse(source, target, output)
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        if result['status'] == 'done':
+            latencies.append(time.monotonic() - started)
+            sizes["output_bytes"] += os.path.getsize(output)
+            sizes["compressed_jobs"] += bool(result.get('compress'))
+
+    await asyncio.gather(*(run_one(*job) for job in jobs))
+    return sorted(latencies), statuses, sizes
+
+
+async def benchmark(args, compress=0, output_format=None):
+    port = free_port()
+    process = start_server(port, args)
+    counter = WireCounter(port, args.bandwidth_mbps * 125000 if args.bandwidth_mbps else None)
+    relay_port = await counter.start()
+    app_url = f"http://127.0.0.1:{relay_port}/"
+    websocket_url = f"ws://127.0.0.1:{relay_port}/queue/join"
+    transcoder = Transcoder(output_format) if output_format is not None else None
+    try:
+        await wait_for_server(app_url, process)
+        with tempfile.TemporaryDirectory(prefix='fusion-bench-') as directory:
+            write = write_input
+            size = args.input_size
+            if args.image_inputs:
+                write, size = write_image, args.image_inputs
+            source = os.path.join(directory, 'source.png')
+            write(source, size)
+            jobs = []
+            for i in range(args.jobs):
+                # Distinct targets so every job encodes and sends its own payload
+                target = os.path.join(directory, f'target_{i}.png')
+                write(target, size)
+                extension = output_format.extension if output_format is not None else '.png'
+                jobs.append((source, target, os.path.join(directory, f'output_{i}{extension}')))
+            input_bytes = os.path.getsize(jobs[0][1]) if jobs else 0
+
+            scheduler = None
+            if args.adaptive:
+                limiter = AdaptiveLimiter(initial=min(4, args.concurrency), maximum=args.concurrency)
+                scheduler = AdaptiveScheduler(limiter)
+
+            rss_before = peak_rss_mb()
+            cpu_before = cpu_seconds()
+            # Count only the jobs, not the readiness probes
+            counter.bytes_up = counter.bytes_down = 0
+            started = time.monotonic()
+            async with FusionSession(app_url, websocket_url, concurrency=args.concurrency,
+                                     process_timeout=args.timeout, compress=compress,
+                                     transcoder=transcoder) as session:
+                latencies, statuses, sizes = await run_jobs(session, jobs, args.concurrency, scheduler)
+            wall = time.monotonic() - started
+            cpu = cpu_seconds() - cpu_before
+        done = statuses.get('done', 0)
+
+        report = {
+            "jobs": args.jobs,
+            "concurrency": args.concurrency,
+            "adaptive": args.adaptive,
+            "input_bytes": input_bytes,
+            "compress": compress,
+            "compressed_jobs": sizes["compressed_jobs"],
+            "output_format": output_format.format if output_format is not None else 'png',
+            "output_quality": output_format.quality if output_format is not None else None,
+            "statuses": statuses,
+            "wall_seconds": round(wall, 3),
+            "jobs_per_second": round(statuses.get('done', 0) / wall, 2) if wall else None,
+            "latency_p50": percentile(latencies, 0.50),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_p99": percentile(latencies, 0.99),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "peak_rss_growth_mb": round(peak_rss_mb() - rss_before, 1),
+            "cpu_ms_per_job": round(cpu * 1000 / args.jobs, 2) if args.jobs else None,
+            "bytes_up_per_job": round(counter.bytes_up / args.jobs) if args.jobs else None,
+            "bytes_down_per_job": round(counter.bytes_down / args.jobs) if args.jobs else None,
+            "output_bytes_per_job": round(sizes["output_bytes"] / done) if done else None,
+            "server": await fetch_server_stats(app_url),
+        }
+        for key in ('latency_p50', 'latency_p95', 'latency_p99'):
+            if report[key] is not None:
+                report[key] = round(report[key], 4)
+        return report
+    finally:
+        await counter.close()
+        if transcoder is not None:
+            transcoder.close()
+        process.terminate()
+        process.wait()
+
+
+def change(before, after):
+    # Relative change in percent, or None when either side is missing
+    if not before or after is None:
+        return None
+    return round((after - before) * 100 / before, 1)
+
+
+def compare(baseline, candidate):
+    wire = {key: (report['bytes_up_per_job'] or 0) + (report['bytes_down_per_job'] or 0)
+            for key, report in (('baseline', baseline), ('candidate', candidate))}
+    return {
+        "bytes_up_per_job_pct": change(baseline['bytes_up_per_job'], candidate['bytes_up_per_job']),
+        "bytes_down_per_job_pct": change(baseline['bytes_down_per_job'], candidate['bytes_down_per_job']),
+        "wire_bytes_per_job_pct": change(wire['baseline'], wire['candidate']),
+        "output_bytes_per_job_pct": change(baseline['output_bytes_per_job'], candidate['output_bytes_per_job']),
+        "latency_p50_pct": change(baseline['latency_p50'], candidate['latency_p50']),
+        "latency_p95_pct": change(baseline['latency_p95'], candidate['latency_p95']),
+        "cpu_ms_per_job_pct": change(baseline['cpu_ms_per_job'], candidate['cpu_ms_per_job']),
+    }
+
+
+def print_report(report):
+    print(f"Jobs: {report['jobs']} at concurrency {report['concurrency']}"
+          f"{' (adaptive)' if report['adaptive'] else ''}, inputs {report['input_bytes']} bytes")
+    print(f"Transport: compression {'offered' if report['compress'] else 'off'}"
+          f" ({report['compressed_jobs']} job(s) compressed), outputs as {report['output_format']}"
+          f"{'' if report['output_quality'] is None else ' q' + str(report['output_quality'])}")
+    print(f"Statuses: {json.dumps(report['statuses'])}")
+    print(f"Throughput: {report['jobs_per_second']} jobs/sec over {report['wall_seconds']}s")
+    print(f"Latency: p50 {report['latency_p50']}s, p95 {report['latency_p95']}s, p99 {report['latency_p99']}s")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB (+{report['peak_rss_growth_mb']} MB during the run)")
+    print(f"CPU: {report['cpu_ms_per_job']} ms per job")
+    print(f"Wire: {report['bytes_up_per_job']} bytes up, {report['bytes_down_per_job']} bytes down per job; "
+          f"outputs {report['output_bytes_per_job']} bytes on disk")
+    if report['server'] is not None:
+        print(f"Server: {json.dumps(report['server'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fusion client against a local mock Gradio queue.")
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--adaptive', action='store_true', help="Use the adaptive AIMD scheduler")
+    parser.add_argument('--input-size', type=int, default=256 * 1024, help="Bytes per synthetic input image")
+    parser.add_argument('--timeout', type=float, default=10, help="Per-job processing timeout in seconds")
+    parser.add_argument('--json', action='store_true', help="Print the report as one JSON object")
+    server = parser.add_argument_group('mock server')
+    server.add_argument('--latency', type=float, default=0.05, help="Simulated processing time in seconds")
+    server.add_argument('--latency-jitter', type=float, default=0.0)
+    server.add_argument('--workers', type=int, help="Jobs the server processes at once")
+    server.add_argument('--capacity', type=int, help="Server answers queue_full beyond this many jobs")
+    server.add_argument('--output-mode', choices=['data', 'file'], default='data')
+    server.add_argument('--output-size', type=int, help="Bytes per synthetic output instead of an echo")
+    server.add_argument('--error-rate', type=float, default=0.0)
+    server.add_argument('--queue-full-rate', type=float, default=0.0)
+    server.add_argument('--drop-rate', type=float, default=0.0)
+    server.add_argument('--stall-rate', type=float, default=0.0)
+    server.add_argument('--seed', type=int)
+    server.add_argument('--server-no-compress', action='store_true', help="Server declines permessage-deflate")
+    transport = parser.add_argument_group('transport')
+    transport.add_argument('--compress', action='store_true', help="Offer permessage-deflate")
+    transport.add_argument('--output-format', choices=sorted(OUTPUT_FORMATS), help="Transcode outputs to this format")
+    transport.add_argument('--output-quality', type=int, help="JPEG/WebP quality (default: lossless WebP, JPEG 90)")
+    transport.add_argument('--image-inputs', type=int, metavar='SIDE',
+                           help="Use real PNG images SIDE pixels square instead of random bytes (for transcoding)")
+    transport.add_argument('--bandwidth-mbps', type=float,
+                           help="Pace the relay to this many megabits per second each way, like a slow proxy")
+    transport.add_argument('--compare', action='store_true',
+                           help="Also run an uncompressed PNG-output baseline and report the change")
+    args = parser.parse_args()
+    if args.image_inputs and Image is None:
+        parser.error("--image-inputs needs Pillow.")
+
+    output_format = None
+    if args.output_format:
+        quality = args.output_quality
+        if quality is None and args.output_format == 'jpeg':
+            quality = 90
+        output_format = OutputFormat(args.output_format, quality)
+    compress = fusionengine.WS_COMPRESS if args.compress else 0
+
+    if not args.compare:
+        report = asyncio.run(benchmark(args, compress, output_format))
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_report(report)
+        return
+
+    baseline = asyncio.run(benchmark(args, 0, None))
+    candidate = asyncio.run(benchmark(args, compress, output_format))
+    changes = compare(baseline, candidate)
+    if args.json:
+        print(json.dumps({"baseline": baseline, "candidate": candidate, "change": changes}))
+        return
+    print("Baseline:")
+    print_report(baseline)
+    print("\nCandidate:")
+    print_report(candidate)
+    print(f"\nChange vs baseline (%): {json.dumps(changes)}")
+
+
+if __name__ == "__main__":
+    main()
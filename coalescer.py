@@ -0,0 +1,191 @@
+import asyncio
+import itertools
+import os
+import shutil
+import tempfile
+
+import fusionengine
+from downloads import part_path_for
+
+
+def deliver(path, output_path, last):
+    # The last waiter takes the shared file itself; the others get copies
+    if os.path.abspath(path) == os.path.abspath(output_path):
+        return
+    if last:
+        shutil.move(path, output_path)
+    else:
+        shutil.copyfile(path, output_path)
+
+
+class Flight:
+    # One shared queue job and the callers waiting on it
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.task = None
+        self.waiters = 0
+        self.listeners = []
+        self.lock = asyncio.Lock()
+
+    def on_estimation(self, data):
+        for listener in list(self.listeners):
+            listener(data)
+
+
+class CoalescingSession:
+    # Single-flight layer: identical submissions in flight at the same time (same content hashes of
+    # source and target, same fn_index) share one queue job and one GPU slot, and each caller gets
+    # the result at its own output path. A caller that gives up (is cancelled) only stops waiting;
+    # the job is cancelled once no caller is left waiting for it. Shared outputs are written to a
+    # directory of the coalescer's own (directory, or a temporary one), since any caller's own
+    # output location may go away with that caller. Offers the same restore_cached()/fuse()
+    # interface as the session it wraps.
+    #
+    # fuse() takes an optional admit(run) coroutine function, e.g. a FairQueue or semaphore, which
+    # must call run(on_estimation) once a slot is free. Only the job sent to the server goes through
+    # it, so identical submissions share one slot as well as one GPU call (and wait in the queue
+    # under the first submission's priority).
+
+    def __init__(self, session, directory=None):
+        self.session = session
+        self.directory = directory
+        self.temporary = directory is None
+        self.counter = itertools.count(1)
+        self.flights = {}
+        self.jobs = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.abandoned = 0
+        self.fn_index = session.fn_index
+        self.input_cache = session.input_cache
+        self.upload_refs = session.upload_refs
+        self.result_cache = session.result_cache
+        self.preprocessor = session.preprocessor
+        self.transcoder = session.transcoder
+        self.telemetry = session.telemetry
+
+    @property
+    def bootstraps(self):
+        return self.session.bootstraps
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        await self.session.start()
+
+    async def close(self):
+        await self.session.close()
+        if self.temporary and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def shared_path(self, output_path):
+        # Where a shared job writes its output before it is handed to each waiter, keeping the extension
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='facefusion-coalesce-')
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"shared_{next(self.counter)}{os.path.splitext(output_path)[1]}")
+
+    async def ensure_cookies(self):
+        await self.session.ensure_cookies()
+
+    async def restore_cached(self, source, target, output_path='fused_image.png', fn_index=None):
+        return await self.session.restore_cached(source, target, output_path, fn_index)
+
+    async def job_key(self, source, target, fn_index):
+        source_hash = await fusionengine.input_digest(source, self.input_cache)
+        target_hash = await fusionengine.input_digest(target, self.input_cache)
+        return source_hash, target_hash, fn_index
+
+    async def fuse(self, source, target, output_path='fused_image.png', check_cache=True, on_estimation=None,
+                   admit=None, **overrides):
+        if check_cache:
+            cached = await self.restore_cached(source, target, output_path, overrides.get('fn_index'))
+            if cached is not None:
+                return cached
+
+        self.jobs += 1
+        key = await self.job_key(source, target, overrides.get('fn_index', self.fn_index))
+        flight = self.flights.get(key)
+        follower = flight is not None and not flight.task.done()
+        if follower:
+            self.coalesced += 1
+            if self.telemetry is not None:
+                self.telemetry.record_coalesced()
+        else:
+            # The first caller's settings (timeouts and other overrides) run the shared job
+            flight = Flight(key, self.shared_path(output_path))
+            flight.task = asyncio.create_task(self.fly(flight, source, target, admit, overrides))
+            self.flights[key] = flight
+            # Submissions arriving after the outcome start a new job
+            flight.task.add_done_callback(lambda task, flight=flight: self.ground(flight))
+        return await self.wait(flight, source, target, output_path, on_estimation, follower)
+
+    async def fly(self, flight, source, target, admit, overrides):
+        def run(on_estimation):
+            def estimation(data):
+                if on_estimation is not None:
+                    on_estimation(data)
+                flight.on_estimation(data)
+            return self.session.fuse(source, target, flight.path, check_cache=False, on_estimation=estimation,
+                                     **overrides)
+
+        if admit is None:
+            return await run(None)
+        return await admit(run)
+
+    async def wait(self, flight, source, target, output_path, on_estimation, follower):
+        flight.waiters += 1
+        if on_estimation is not None:
+            flight.listeners.append(on_estimation)
+        try:
+            result = await asyncio.shield(flight.task)
+            result = dict(result, source=getattr(source, 'path', source), target=getattr(target, 'path', target),
+                          output=output_path, timings=dict(result.get('timings') or {}))
+            if follower:
+                result["coalesced"] = True
+            if result['status'] == 'done':
+                # One delivery at a time, so the waiter that moves the file goes after every copy
+                async with flight.lock:
+                    await asyncio.to_thread(deliver, flight.path, output_path, flight.waiters == 1)
+            return result
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            flight.waiters -= 1
+            if on_estimation is not None:
+                flight.listeners.remove(on_estimation)
+            if flight.waiters == 0:
+                await self.land(flight)
+
+    def ground(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    async def land(self, flight):
+        # Nobody is waiting any more: stop the job if it is still running, and clean up its output
+        if not flight.task.done():
+            # Out of the table first, so nobody joins a job that is being cancelled
+            self.ground(flight)
+            self.abandoned += 1
+            flight.task.cancel()
+            await asyncio.gather(flight.task, return_exceptions=True)
+        for path in (flight.path, part_path_for(flight.path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self):
+        return {
+            "jobs": self.jobs,
+            "gpu_calls_saved": self.coalesced,
+            "in_flight": len(self.flights),
+            "cancelled_waiters": self.cancelled,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,82 @@
+import asyncio
+import binascii
+import os
+
+import aiohttp
+
+# Bytes read from the network, and base64 characters decoded, per step
+CHUNK_SIZE = 256 * 1024
+
+# Extra attempts after a dropped connection; each resumes from the bytes already on disk
+DOWNLOAD_RETRIES = 3
+
+
+class DownloadError(Exception):
+    pass
+
+
+def part_path_for(output_path):
+    return f"{output_path}.part"
+
+
+async def download_file(http, url, output_path, retries=DOWNLOAD_RETRIES, accept=None):
+    # Stream url to output_path in chunks. Bytes go to "<output>.part" first, a dropped connection
+    # resumes with a Range request, and the finished file is renamed into place atomically.
+    # accept, if given, is sent as the Accept header.
+    part_path = part_path_for(output_path)
+    # A part file left by an earlier call (a crashed run, a cancelled or hedged attempt) may hold
+    # another file's bytes, so only what this call wrote is ever resumed
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Accept': accept} if accept else {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        try:
+            async with http.get(url, headers=headers) as response:
+                if response.status == 416 and offset:
+                    # Nothing left to fetch: the previous attempt wrote the whole body
+                    break
+                if response.status == 200:
+                    # The server ignored (or we did not send) the Range header; start over
+                    mode = 'wb'
+                elif response.status == 206 and offset:
+                    mode = 'ab'
+                else:
+                    raise DownloadError(f"Failed to download image. Status code: {response.status}")
+                with open(part_path, mode) as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        f.write(chunk)
+            break
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise DownloadError(f"Failed to download image after {retries + 1} attempts: {e}") from e
+    os.replace(part_path, output_path)
+
+
+def decode_base64_to_file(encoded, output_path, start=0, end=None):
+    # Decode base64 text (str or bytes-like), or just encoded[start:end], to output_path a chunk at
+    # a time, so neither the decoded image nor a copy of the text exists in memory as a whole;
+    # written via "<output>.part" and renamed into place
+    part_path = part_path_for(output_path)
+    step = CHUNK_SIZE - CHUNK_SIZE % 4
+    if not isinstance(encoded, str):
+        encoded = memoryview(encoded)
+    end = len(encoded) if end is None else end
+    try:
+        with open(part_path, 'wb') as f:
+            for offset in range(start, end, step):
+                f.write(binascii.a2b_base64(encoded[offset:min(offset + step, end)]))
+    except binascii.Error:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, output_path)
+
+
+def decode_data_url_to_file(data_url, output_path, start=0, end=None):
+    # Skip the "data:<mime>;base64," header and decode the rest incrementally; start/end select
+    # a data URL inside a larger text, such as the frame it arrived in
+    end = len(data_url) if end is None else end
+    comma = data_url.index(',' if isinstance(data_url, str) else b',', start, end)
+    decode_base64_to_file(data_url, output_path, comma + 1, end)
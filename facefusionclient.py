@@ -0,0 +1,140 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+import fusionengine
+from coalescer import CoalescingSession
+from fairqueue import FairQueue
+from fusionsession import FusionSession
+from loadbalancer import LoadBalancer
+
+# Number of queue sessions fuse_many() keeps in flight by default
+DEFAULT_CONCURRENCY = 8
+
+
+class FusionError(RuntimeError):
+    # A job that did not produce an output; result holds the full result record
+    def __init__(self, result):
+        super().__init__(result.get('error') or result.get('status'))
+        self.result = result
+
+
+class FaceFusionClient:
+    # Blocking client for scripts and services that are not asyncio programs themselves.
+    # One FusionSession (or LoadBalancer when endpoints are given) lives on a private event loop
+    # thread for the lifetime of the client, so cookies, pooled connections and caches carry over
+    # from call to call. asyncio code should use FusionSession directly instead.
+    # With coalesce=True, identical calls in flight at the same time (e.g. from several producer
+    # threads) share one queue job; each caller still gets its own file or bytes.
+    # Calls wait in a FairQueue: fuse() is "interactive" and fuse_many() "bulk" unless told otherwise,
+    # so single images are not stuck behind a large batch; tenant and deadline are passed through.
+    #
+    #     with FaceFusionClient(app_url, websocket_url) as client:
+    #         client.fuse('source.jpg', 'target.jpg', 'fused.png')
+    #         image_bytes = client.fuse('source.jpg', 'other.jpg')
+    #         results = client.fuse_many([('source.jpg', 'a.jpg', 'a_fused.png'), ...])
+
+    def __init__(self, app_url=None, websocket_url=None, endpoints=None, concurrency=DEFAULT_CONCURRENCY,
+                 coalesce=False, tenant_weights=None, **session_options):
+        self.concurrency = concurrency
+        if endpoints:
+            self.session = LoadBalancer(endpoints, concurrency=concurrency, **session_options)
+        else:
+            self.session = FusionSession(app_url or fusionengine.APP_URL,
+                                         websocket_url or fusionengine.WEBSOCKET_URL,
+                                         concurrency=concurrency, **session_options)
+        if coalesce:
+            self.session = CoalescingSession(self.session)
+        self.queue = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='facefusion-client', daemon=True)
+        self.thread.start()
+        self.run(self.start(tenant_weights))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def start(self, tenant_weights):
+        # The queue's futures belong to the client's loop, so it is created there
+        self.queue = FairQueue(self.concurrency, tenant_weights=tenant_weights)
+        if self.session.telemetry is not None:
+            self.session.telemetry.attach_queue(self.queue)
+        await self.session.start()
+
+    async def submit(self, source, target, output_path, priority, tenant, deadline):
+        # A missing input fails its job with a record, like any other failure
+        for path in (source, target):
+            if not os.path.isfile(path):
+                result = fusionengine.new_result(source, target, output_path)
+                result.update(status="failed", error=f"Image file {path} does not exist.", elapsed=0.0)
+                return result
+
+        def admit(run):
+            return self.queue.submit(run, priority, tenant, deadline,
+                                     record={"source": source, "target": target, "output": output_path})
+
+        if isinstance(self.session, CoalescingSession):
+            # Coalesce before queueing, so identical calls take one slot rather than one each
+            return await self.session.fuse(source, target, output_path, admit=admit)
+        return await admit(lambda on_estimation: self.session.fuse(source, target, output_path,
+                                                                   on_estimation=on_estimation))
+
+    def run(self, coroutine):
+        # Run a coroutine on the client's loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def fuse_result(self, source, target, output_path, priority='interactive', tenant=None, deadline=None):
+        # Fuse one pair and return its result record without raising on failure. deadline is in
+        # seconds; a call still waiting for its turn by then comes back "expired".
+        return self.run(self.submit(source, target, output_path, priority, tenant, deadline))
+
+    def fuse(self, source, target, output_path=None, priority='interactive', tenant=None, deadline=None):
+        # Fuse one pair. With output_path, writes the image there and returns the path; without,
+        # returns the image bytes. Raises FusionError when no output was produced.
+        if output_path is not None:
+            result = self.fuse_result(source, target, output_path, priority, tenant, deadline)
+            if result['status'] != 'done':
+                raise FusionError(result)
+            return output_path
+        with tempfile.TemporaryDirectory(prefix='facefusion-') as directory:
+            path = os.path.join(directory, 'fused.png')
+            result = self.fuse_result(source, target, path, priority, tenant, deadline)
+            if result['status'] != 'done':
+                raise FusionError(result)
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def fuse_many(self, jobs, concurrency=None, priority='bulk', tenant=None):
+        # Fuse (source, target, output_path) tuples or {"source", "target", "output"} dicts with up to
+        # concurrency jobs in flight (by default the client's own limit applies); returns the result
+        # records in the order of jobs. Dicts may set their own "priority", "tenant" and "deadline".
+        async def run_all():
+            limit = asyncio.Semaphore(concurrency) if concurrency else None
+
+            async def run_one(job):
+                options = {"priority": priority, "tenant": tenant, "deadline": None}
+                if isinstance(job, dict):
+                    source, target, output_path = job['source'], job['target'], job['output']
+                    options.update((key, job[key]) for key in options if job.get(key) is not None)
+                else:
+                    source, target, output_path = job
+                if limit is None:
+                    return await self.submit(source, target, output_path, **options)
+                async with limit:
+                    return await self.submit(source, target, output_path, **options)
+
+            return await asyncio.gather(*(run_one(job) for job in jobs))
+
+        return self.run(run_all())
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
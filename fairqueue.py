@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from scheduler import QUEUE_FULL_RETRIES, backoff_delay
+from telemetry import Histogram
+
+# Priority classes and their weights: when every class has work waiting, each gets dispatch slots
+# in proportion to its weight, so bulk work still moves while interactive jobs go first
+CLASS_WEIGHTS = {'interactive': 16, 'standard': 4, 'bulk': 1}
+DEFAULT_CLASS = 'standard'
+DEFAULT_TENANT = 'default'
+
+# A job whose deadline is closer than its expected time to finish (the server's recent rank_eta on
+# joining plus the recent process time) plus this many seconds skips ahead, earliest deadline first
+DEADLINE_SLACK = 2.0
+
+# Weight of each new sample in the running estimates of queue wait and process time
+ESTIMATE_ALPHA = 0.2
+
+
+class Ticket:
+    __slots__ = ('seq', 'job_class', 'tenant', 'deadline', 'tag', 'enqueued', 'granted', 'state',
+                 'estimated')
+
+    def __init__(self, seq, job_class, tenant, deadline, tag):
+        self.seq = seq
+        self.job_class = job_class
+        self.tenant = tenant
+        self.deadline = deadline  # time.monotonic() by which the job should finish, or None
+        self.tag = tag  # Virtual start time; lower tags are served first
+        self.enqueued = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+        self.state = 'waiting'  # waiting, running, expired, cancelled or done
+        self.estimated = False
+
+
+class FairQueue:
+    # Client-side admission queue in front of /queue/join. Jobs wait here, not in the server's FIFO,
+    # until one of the concurrency slots (or the AdaptiveLimiter's limit) is free, and are then let
+    # through in start-time fair queuing order over (class, tenant) flows weighted by
+    # CLASS_WEIGHTS[class] * tenant_weights[tenant]: a flow with little backlog (an interactive
+    # request) is served almost at once even behind a long bulk backlog, and tenants of one class
+    # share it by weight. Jobs at risk of missing their deadline jump the order, and jobs whose
+    # deadline passes while still waiting here are answered "expired" without taking a GPU slot.
+
+    def __init__(self, concurrency=4, limiter=None, class_weights=None, tenant_weights=None,
+                 queue_full_retries=QUEUE_FULL_RETRIES):
+        self.concurrency = concurrency
+        self.limiter = limiter  # An AdaptiveLimiter whose limit replaces the fixed concurrency
+        self.class_weights = dict(CLASS_WEIGHTS, **(class_weights or {}))
+        self.tenant_weights = tenant_weights or {}
+        self.queue_full_retries = queue_full_retries
+        self.seq = itertools.count()
+        self.by_tag = []
+        self.by_deadline = []
+        self.flow_finish = {}  # (class, tenant) -> virtual finish time of its last queued job
+        self.virtual_time = 0.0
+        self.in_flight = 0
+        self.join_eta = None  # Running estimate of the server's rank_eta when a job joins
+        self.process_time = None  # Running estimate of the server's process time
+        self.retries = 0
+        self.waiting = {name: 0 for name in self.class_weights}
+        self.running = {name: 0 for name in self.class_weights}
+        self.served = {name: 0 for name in self.class_weights}
+        self.promoted = {name: 0 for name in self.class_weights}
+        self.expired = {name: 0 for name in self.class_weights}
+        self.wait_seconds = {name: Histogram() for name in self.class_weights}
+
+    def capacity(self):
+        if self.limiter is not None:
+            return max(1, int(self.limiter.limit))
+        return self.concurrency
+
+    def weight(self, job_class, tenant):
+        return self.class_weights[job_class] * self.tenant_weights.get(tenant, 1)
+
+    def expected_service(self):
+        # Seconds a job let through now should take on the server
+        return (self.join_eta or 0.0) + (self.process_time or 0.0)
+
+    def check_class(self, job_class):
+        if job_class not in self.class_weights:
+            raise ValueError(f"Unknown priority class {job_class!r}; expected one of {sorted(self.class_weights)}")
+
+    def enqueue(self, job_class, tenant, deadline):
+        self.check_class(job_class)
+        flow = (job_class, tenant)
+        tag = max(self.virtual_time, self.flow_finish.get(flow, 0.0))
+        self.flow_finish[flow] = tag + 1.0 / self.weight(job_class, tenant)
+        ticket = Ticket(next(self.seq), job_class, tenant, deadline, tag)
+        heapq.heappush(self.by_tag, (ticket.tag, ticket.seq, ticket))
+        if deadline is not None:
+            heapq.heappush(self.by_deadline, (deadline, ticket.seq, ticket))
+        self.waiting[job_class] += 1
+        return ticket
+
+    def next_ticket(self):
+        # Skipped entries were granted, expired or cancelled through the other heap
+        for heap in (self.by_deadline, self.by_tag):
+            while heap and heap[0][2].state != 'waiting':
+                heapq.heappop(heap)
+        if self.by_deadline:
+            deadline, seq, ticket = self.by_deadline[0]
+            if deadline - time.monotonic() - self.expected_service() <= DEADLINE_SLACK:
+                heapq.heappop(self.by_deadline)
+                self.promoted[ticket.job_class] += 1
+                return ticket
+        if self.by_tag:
+            ticket = heapq.heappop(self.by_tag)[2]
+            # Virtual time follows the fair order only; a promotion out of turn does not advance it
+            self.virtual_time = max(self.virtual_time, ticket.tag)
+            return ticket
+        return None
+
+    def dispatch(self):
+        while self.in_flight < self.capacity():
+            ticket = self.next_ticket()
+            if ticket is None:
+                return
+            ticket.state = 'running'
+            self.in_flight += 1
+            if self.limiter is not None:
+                self.limiter.in_flight += 1
+            self.waiting[ticket.job_class] -= 1
+            self.running[ticket.job_class] += 1
+            self.served[ticket.job_class] += 1
+            self.wait_seconds[ticket.job_class].observe(time.monotonic() - ticket.enqueued)
+            ticket.granted.set_result(None)
+
+    async def acquire(self, job_class=DEFAULT_CLASS, tenant=DEFAULT_TENANT, deadline=None):
+        # Wait for this job's turn; returns its ticket, or None when its deadline passed first
+        ticket = self.enqueue(job_class, tenant, deadline)
+        self.dispatch()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.granted), timeout)
+        except asyncio.TimeoutError:
+            if ticket.state == 'running':
+                return ticket
+            ticket.state = 'expired'
+            self.waiting[job_class] -= 1
+            self.expired[job_class] += 1
+            return None
+        except asyncio.CancelledError:
+            if ticket.state == 'running':
+                self.release(ticket)
+            elif ticket.state == 'waiting':
+                ticket.state = 'cancelled'
+                self.waiting[job_class] -= 1
+            raise
+        return ticket
+
+    def release(self, ticket, result=None):
+        ticket.state = 'done'
+        self.in_flight -= 1
+        if self.limiter is not None:
+            self.limiter.in_flight -= 1
+        self.running[ticket.job_class] -= 1
+        process = ((result or {}).get('timings') or {}).get('process')
+        if isinstance(process, (int, float)):
+            self.process_time = update_estimate(self.process_time, process)
+        self.dispatch()
+
+    def estimation_callback(self, ticket):
+        # The first estimation of each job tells how long the server queue is on joining
+        def on_estimation(data):
+            rank_eta = data.get('rank_eta')
+            if not ticket.estimated and isinstance(rank_eta, (int, float)):
+                ticket.estimated = True
+                self.join_eta = update_estimate(self.join_eta, rank_eta)
+            if self.limiter is not None:
+                self.limiter.on_estimation(data)
+        return on_estimation
+
+    async def submit(self, run_job, job_class=None, tenant=None, deadline=None, record=None):
+        # Run run_job(on_estimation) in its turn and return its result record. deadline is in seconds
+        # from now; a job still waiting when it passes gets an "expired" record built from record.
+        # With a limiter, queue_full rejections wait out a jittered backoff and queue again.
+        job_class = job_class or DEFAULT_CLASS
+        tenant = tenant or DEFAULT_TENANT
+        self.check_class(job_class)
+        started = time.monotonic()
+        deadline_at = None if deadline is None else started + deadline
+        for attempt in range(self.queue_full_retries + 1):
+            ticket = None
+            if deadline_at is None or deadline_at > time.monotonic():
+                ticket = await self.acquire(job_class, tenant, deadline_at)
+            else:
+                self.expired[job_class] += 1
+            if ticket is None:
+                return dict(record or {}, status="expired", error_type="deadline",
+                            error="Deadline passed while queued.",
+                            elapsed=round(time.monotonic() - started, 3))
+            result = None
+            try:
+                result = await run_job(self.estimation_callback(ticket))
+            finally:
+                self.release(ticket, result)
+            if self.limiter is None or result['status'] != 'queue_full':
+                if self.limiter is not None and result['status'] == 'done':
+                    self.limiter.on_success((result.get('timings') or {}).get('process'))
+                return result
+            self.limiter.on_queue_full()
+            if attempt < self.queue_full_retries:
+                self.retries += 1
+                await asyncio.sleep(backoff_delay(attempt))
+        return result
+
+    def stats(self):
+        classes = {}
+        for name in self.class_weights:
+            histogram = self.wait_seconds[name]
+            classes[name] = {
+                "waiting": self.waiting[name],
+                "running": self.running[name],
+                "served": self.served[name],
+                "promoted": self.promoted[name],
+                "expired": self.expired[name],
+                "mean_wait": round(histogram.total / histogram.count, 4) if histogram.count else None,
+            }
+        stats = {
+            "capacity": self.capacity(),
+            "in_flight": self.in_flight,
+            "expected_service": round(self.expected_service(), 3),
+            "classes": classes,
+        }
+        if self.limiter is not None:
+            stats.update(limiter=self.limiter.stats(), retries=self.retries)
+        return stats
+
+
+def update_estimate(current, sample):
+    return sample if current is None else (1 - ESTIMATE_ALPHA) * current + ESTIMATE_ALPHA * sample
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import time
+
+from batchfusion import add_session_arguments, build_session, release_session
+from inputcache import file_digest
+from payloadencoding import EncodedInput, encode_data_url
+
+# One source face applied to every image in a directory through one persistent session.
+# The Gradio function takes a single (source, target) pair per queue entry, so each target is still
+# its own queue job; what fan-out saves is everything around it. The source is uploaded once via
+# /upload and every frame carries only its file reference (with --no-upload it is encoded once and
+# its bytes are spliced into every frame), cookies and connections are shared, and outputs are
+# written as jobs finish. Targets are listed lazily and
+# handed to a fixed number of workers through a small queue, so at most `concurrency` targets are
+# encoded or held in memory at any time, however large the directory.
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_PATTERNS = ('*.jpg', '*.jpeg', '*.png', '*.webp', '*.bmp')
+
+
+def iter_targets(directory, patterns=DEFAULT_PATTERNS):
+    # Image files in directory in name order; scandir keeps the listing itself cheap
+    names = sorted(entry.name for entry in os.scandir(directory) if entry.is_file()
+                   and any(fnmatch.fnmatch(entry.name.lower(), pattern) for pattern in patterns))
+    for name in names:
+        yield os.path.join(directory, name)
+
+
+def output_path_for(target, output_dir, extension='.png'):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(target))[0] + '_fused' + extension)
+
+
+async def encode_source(session, source):
+    # Encode the source once for every job; with uploads or pre-processing the session's own
+    # per-input handling already does this, keyed on content
+    if session.upload_refs is not None or session.preprocessor is not None:
+        return source
+    if session.input_cache is not None:
+        return await asyncio.to_thread(session.input_cache.get, source)
+
+    def encode():
+        return EncodedInput(source, encode_data_url(source), digest=file_digest(source))
+    return await asyncio.to_thread(encode)
+
+
+async def fan_out(session, source, targets, output_dir, concurrency=DEFAULT_CONCURRENCY, skip_existing=True):
+    # Async generator yielding each target's result record as it finishes (not in input order).
+    # targets may be any iterable, including a lazy one; it is consumed only as workers free up.
+    # A caller that may stop early should wrap it in contextlib.aclosing() so in-flight jobs are
+    # cancelled right away rather than whenever the generator is collected.
+    os.makedirs(output_dir, exist_ok=True)
+    # Outputs are named for the format the session stores them in
+    extension = session.transcoder.output_format.extension if session.transcoder is not None else '.png'
+    source_input = await encode_source(session, source)
+    pending = asyncio.Queue(maxsize=concurrency)
+    finished = asyncio.Queue()
+
+    async def produce():
+        # Workers stop on None. It follows the last target, and also a failure to list the targets,
+        # but not a cancellation, after which nobody is left to take it
+        error = None
+        try:
+            for target in targets:
+                await pending.put(target)
+        except Exception as e:
+            error = e
+        for _ in range(concurrency):
+            await pending.put(None)
+        if error is not None:
+            raise error
+
+    async def fuse_target(target):
+        output_path = output_path_for(target, output_dir, extension)
+        if skip_existing and os.path.isfile(output_path):
+            return {"source": source, "target": target, "output": output_path, "status": "done",
+                    "error": None, "skipped": True}
+        try:
+            result = await session.fuse(source_input, target, output_path)
+        except Exception as e:
+            result = {"source": source, "target": target, "output": output_path, "status": "failed",
+                      "error": f"{type(e).__name__}: {e}"}
+        result["source"] = source
+        return result
+
+    async def work():
+        while True:
+            target = await pending.get()
+            if target is None:
+                await finished.put(None)
+                return
+            await finished.put(await fuse_target(target))
+
+    producer = asyncio.create_task(produce())
+    workers = [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        running = concurrency
+        while running:
+            result = await finished.get()
+            if result is None:
+                running -= 1
+                continue
+            yield result
+        # Surface a failure to list the targets
+        await producer
+    finally:
+        for task in [producer] + workers:
+            task.cancel()
+        await asyncio.gather(producer, *workers, return_exceptions=True)
+
+
+async def run_fan_out(session, args):
+    counts = {"done": 0, "skipped": 0, "cached": 0, "failed": 0}
+    results_file = open(args.results, 'a') if args.results else None
+    started = time.monotonic()
+    try:
+        async with session:
+            await session.ensure_cookies()
+            targets = iter_targets(args.target_dir, args.pattern or DEFAULT_PATTERNS)
+            async for result in fan_out(session, args.source, targets, args.output_dir, args.concurrency,
+                                        skip_existing=not args.overwrite):
+                if result.get('skipped'):
+                    counts["skipped"] += 1
+                elif result['status'] != 'done':
+                    counts["failed"] += 1
+                else:
+                    counts["cached" if result.get('cached') else "done"] += 1
+                if results_file:
+                    results_file.write(json.dumps(result) + '\n')
+                    results_file.flush()
+                print(f"{result['status']}: {result['target']} -> {result['output']}"
+                      + (f" ({result['error']})" if result.get('error') else ""))
+    finally:
+        if results_file:
+            results_file.close()
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    print(f"Fanned out to {total} target(s) in {elapsed:.1f}s "
+          f"({total / elapsed if elapsed else 0:.2f} targets/s): {json.dumps(counts)}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply one source face to every image in a directory.")
+    parser.add_argument('source', help="Source face image")
+    parser.add_argument('target_dir', help="Directory of target images")
+    parser.add_argument('output_dir', help="Where <target>_fused.png (or --output-format) files are written")
+    parser.add_argument('--pattern', action='append',
+                        help="Glob for target file names; repeatable (default: common image types)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Targets in flight (and in memory) at once")
+    parser.add_argument('--overwrite', action='store_true', help="Fuse targets whose output already exists")
+    parser.add_argument('--results', help="Append per-target result records here (JSONL)")
+    add_session_arguments(parser)
+    # Every job shares the source, so sending it once pays off from the second target on
+    parser.set_defaults(upload=True)
+    parser.add_argument('--no-upload', dest='upload', action='store_false',
+                        help="Send the source inline in every frame, for servers without /upload")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.source):
+        parser.error(f"Image file {args.source} does not exist.")
+    if not os.path.isdir(args.target_dir):
+        parser.error(f"{args.target_dir} is not a directory.")
+    session = build_session(parser, args)
+    try:
+        counts = asyncio.run(run_fan_out(session, args))
+    finally:
+        release_session(session, args)
+    if counts["failed"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
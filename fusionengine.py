@@ -0,0 +1,435 @@
+import asyncio
+import logging
+import os
+import ssl
+import time
+import urllib.parse
+import uuid
+
+import aiohttp
+
+import protocol
+from downloads import DownloadError, decode_data_url_to_file, download_file
+from inputcache import file_digest
+from payloadencoding import EncodedInput, build_data_frame
+from protocol import DataURL
+from uploadrefs import UploadError
+
+# Per-message chatter is logged at DEBUG (INFO when verbose) with lazy %-formatting, so nothing is
+# formatted unless a handler will emit it, and message bodies are never logged
+logger = logging.getLogger(__name__)
+
+# Endpoint URLs from environment variables
+APP_URL = os.getenv('APP_URL')  # Load from .env
+WEBSOCKET_URL = os.getenv('WEBSOCKET_URL')  # Load from .env
+
+# Function index (fn_index) as determined from the web interface
+FN_INDEX = 105
+
+# Seconds allowed between process_starts and process_completed
+PROCESS_TIMEOUT = 60
+
+# Seconds allowed for the WebSocket handshake
+CONNECT_TIMEOUT = 30
+
+# Added to deadlines scaled from the server's estimates, so short estimates still leave some slack
+ETA_GRACE = 10
+
+# zlib window bits offered for permessage-deflate when compression is turned on. Base64 text
+# compresses by about a quarter even when the image inside is already compressed, in both
+# directions, but deflating multi-MB frames costs several times the client CPU of sending them, so
+# it only pays off on slow links (benchmark.py --compare --compress --bandwidth-mbps N measures
+# both); servers that do not support the extension simply do not accept it.
+WS_COMPRESS = 15
+
+
+class BootstrapError(Exception):
+    pass
+
+
+class MalformedMessage(Exception):
+    pass
+
+
+def parse_frame(parse, text):
+    # Only a frame that does not parse is malformed; errors while handling a parsed one are not
+    try:
+        return parse(text)
+    except ValueError as e:
+        raise MalformedMessage(str(e)) from e
+
+
+def create_http_session(concurrency=100, verify_ssl=False):
+    # One pooled session shared by every job: cookies, keep-alive connections and DNS cache are reused.
+    # unsafe=True keeps cookies set by IP-address hosts such as a local stand-in server.
+    ssl_context = ssl.create_default_context()
+    if not verify_ssl:
+        # Matches the CERT_NONE the WebSocketApp client used; enable verification in production
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    # Every in-flight job holds one pooled connection for its WebSocket and may need a second one
+    # for the download, so size the pool at twice the job concurrency to avoid starving downloads
+    # Idle connections are kept warm between jobs so downloads reuse them instead of reconnecting.
+    connector = aiohttp.TCPConnector(limit=concurrency * 2, ssl=ssl_context, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+
+async def bootstrap_session(http, app_url=None):
+    # Make an initial request to obtain session cookies and IDs
+    try:
+        async with http.get(app_url or APP_URL) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise BootstrapError(f"Initial request failed: {response.status} - {text}")
+            await response.read()
+    except aiohttp.ClientError as e:
+        raise BootstrapError(str(e)) from e
+    return {cookie.key: cookie.value for cookie in http.cookie_jar}
+
+
+def load_input(value, input_cache=None):
+    # Accept either a path or an already encoded input
+    if isinstance(value, EncodedInput):
+        return value
+    if input_cache is not None:
+        return input_cache.get(value)
+    return EncodedInput.from_path(value)
+
+
+async def input_digest(value, input_cache=None):
+    # Content hash of an input, reusing the cache's (path, size, mtime) index when available
+    if getattr(value, 'digest', None):
+        return value.digest
+    path = getattr(value, 'path', value)
+    if input_cache is not None:
+        return await asyncio.to_thread(input_cache.content_hash, path)
+    return await asyncio.to_thread(file_digest, path)
+
+
+def new_result(source, target, output_path):
+    return {
+        "source": getattr(source, 'path', source),
+        "target": getattr(target, 'path', target),
+        "output": output_path,
+        "status": "failed",
+        "error": None,
+        # connection, handshake, upload, queue_full, server_error, queue_timeout, timeout, process or output
+        "error_type": None,
+        "elapsed": None,
+        # Seconds spent in each phase of the job
+        "timings": {},
+    }
+
+
+async def restore_cached_result(result_cache, source, target, output_path='fused_image.png',
+                                fn_index=FN_INDEX, input_cache=None):
+    # Serve a job from the result cache without any network work; returns None on a miss
+    started = time.monotonic()
+    source_hash = await input_digest(source, input_cache)
+    target_hash = await input_digest(target, input_cache)
+    if not await asyncio.to_thread(result_cache.restore, source_hash, target_hash, fn_index, output_path):
+        return None
+    result = new_result(source, target, output_path)
+    result.update(status="done", cached=True, elapsed=round(time.monotonic() - started, 3))
+    return result
+
+
+async def run_fusion(http, cookies, source, target, output_path='fused_image.png',
+                     app_url=None, websocket_url=None, fn_index=FN_INDEX,
+                     process_timeout=PROCESS_TIMEOUT, connect_timeout=CONNECT_TIMEOUT, queue_timeout=None,
+                     eta_scale=None, input_cache=None,
+                     upload_refs=None, result_cache=None, on_estimation=None, on_state=None, trace=None,
+                     compress=0, accept=None, verbose=True):
+    # Run a single source/target pair through /queue/join and return a result record.
+    # source and target are paths or EncodedInput objects; passing encoded inputs lets callers
+    # that retry a job reuse the encoding instead of reading the files again.
+    # With upload_refs (an UploadReferenceCache) inputs are uploaded once and sent as file references.
+    # With result_cache (a ResultCache) successful outputs are stored; callers look them up first
+    # with restore_cached_result() so hits skip the network entirely.
+    # on_estimation, if given, is called with every estimation message (rank_eta, queue_size, ...).
+    # on_state, if given, is called with "uploaded", "submitted" (joined the queue) and "processing".
+    # Deadlines: connect_timeout for the handshake; queue_timeout (None waits forever) from joining
+    # the queue to process_starts; process_timeout from process_starts to process_completed.
+    # With eta_scale, each estimation re-arms the queue deadline at eta_scale * rank_eta + ETA_GRACE
+    # (capped by queue_timeout), and the processing deadline grows to eta_scale times the server's
+    # reported average process time when that is longer than process_timeout.
+    # trace, a telemetry.JobTrace, receives a span per phase and an event per estimation.
+    # compress, when non-zero (e.g. WS_COMPRESS), offers permessage-deflate with that many window
+    # bits; accept is the Accept header sent when the output is downloaded as a file (see
+    # outputformat.OutputFormat).
+    base_url = app_url or APP_URL
+    log = logger.info if verbose else logger.debug
+
+    result = new_result(source, target, output_path)
+    timings = result["timings"]
+    started = time.monotonic()
+
+    def end_phase(name, phase_started):
+        # Record a phase in the timings and, when tracing, as a span; returns the end time
+        ended = time.monotonic()
+        timings[name] = round(ended - phase_started, 4)
+        if trace is not None:
+            trace.add_span(name, phase_started, ended)
+        return ended
+
+    session_id = cookies.get('session_id', '')
+    session_hash = cookies.get('session_hash', '')
+    if not session_hash:
+        # Generate a random session hash if not provided
+        session_hash = str(uuid.uuid4()).replace("-", "")[:16]
+
+    # Prepare the headers with cookies for the WebSocket connection
+    cookie_header = '; '.join([f'{key}={value}' for key, value in cookies.items()])
+
+    async def save_output(image_data):
+        # Handle data URL, as a span of the frame text or a plain string
+        try:
+            if isinstance(image_data, DataURL) and image_data.startswith("data:image"):
+                # Decode the base64 data to disk in chunks straight from the frame
+                await asyncio.to_thread(decode_data_url_to_file, image_data.text, output_path,
+                                        image_data.start, image_data.end)
+                log("Fused image saved to %s", output_path)
+                return None
+            if isinstance(image_data, str) and image_data.startswith("data:image"):
+                await asyncio.to_thread(decode_data_url_to_file, image_data, output_path)
+                log("Fused image saved to %s", output_path)
+                return None
+        except ValueError as e:
+            # binascii.Error (bad base64) or a data URL without a comma
+            return f"Could not decode output image: {e}"
+        # Handle file path
+        if isinstance(image_data, dict):
+            # Depending on the server response, adjust the parsing
+            if image_data.get('__type__') == 'update':
+                value = image_data.get('value')
+                if isinstance(value, list) and len(value) > 0:
+                    file_name = value[0].get('name')
+                else:
+                    return "No file information found in 'value'."
+            else:
+                file_name = image_data.get('name')
+
+            if not file_name:
+                return "File name not found in output."
+            # Construct the file URL
+            encoded_file_name = urllib.parse.quote(file_name)
+            file_url = f"{base_url.rstrip('/')}/file={encoded_file_name}"
+            log("Downloading image from %s", file_url)
+            # Stream the file over the shared session's pooled connections
+            try:
+                await download_file(http, file_url, output_path, accept=accept)
+            except DownloadError as e:
+                return str(e)
+            log("Fused image saved to %s", output_path)
+            return None
+        return "Unexpected output format."
+
+    # The data frame is built on the first send_data and reused if the server asks again
+    frame = None
+    # (digest, file reference) per input in upload mode
+    references = None
+    # Protocol phase (joining, queued or processing) and the armed deadline's length, which
+    # also tells a queue timeout from a processing timeout
+    progress = {"phase": "joining", "seconds": queue_timeout}
+
+    def encode_frame():
+        if references is not None:
+            inputs = [reference for digest, reference in references] + [None]
+            return build_data_frame(inputs, fn_index, session_hash, session_id)
+        inputs = [
+            load_input(source, input_cache),  # First image
+            load_input(target, input_cache),  # Second image
+            None                              # Additional parameter (if any)
+        ]
+        return build_data_frame(inputs, fn_index, session_hash, session_id)
+
+    async def run_protocol(ws):
+        loop = asyncio.get_running_loop()
+        connected = time.monotonic()
+        marks = {"queued": connected, "process_started": connected}
+        # The queue deadline (if any) runs until process_starts arms the processing deadline
+        queue_deadline = None if queue_timeout is None else loop.time() + queue_timeout
+        deadlines = {"current": queue_deadline, "process_estimate": None}
+
+        # Handlers take the raw frame text and parse only what they need; a non-None return
+        # (status, error, error_type) ends the job
+        async def on_send_hash(text):
+            log("Received send_hash message.")
+            # Send the session hash back to the server
+            await ws.send_str(protocol.dumps({
+                "session_hash": session_hash,
+                "fn_index": fn_index,
+                "session_id": session_id,
+                "msg": "send_hash"
+            }))
+            marks["queued"] = end_phase("send_hash", connected)
+            progress["phase"] = "queued"
+            if on_state is not None:
+                on_state("submitted")
+
+        async def on_estimation_message(text):
+            # Received estimation of processing time
+            data = parse_frame(protocol.loads, text)
+            rank_eta = data.get('rank_eta')
+            log("Estimated time: %ss, Queue size: %s", rank_eta, data.get('queue_size'))
+            if eta_scale is not None:
+                if isinstance(rank_eta, (int, float)) and progress["phase"] != "processing":
+                    seconds = eta_scale * rank_eta + ETA_GRACE
+                    deadlines["current"] = loop.time() + seconds
+                    if queue_deadline is not None and queue_deadline < deadlines["current"]:
+                        deadlines["current"], seconds = queue_deadline, queue_timeout
+                    progress["seconds"] = round(seconds, 1)
+                if isinstance(data.get('avg_event_process_time'), (int, float)):
+                    deadlines["process_estimate"] = eta_scale * data['avg_event_process_time'] + ETA_GRACE
+            if trace is not None:
+                trace.add_event("estimation", rank=data.get('rank'), queue_size=data.get('queue_size'),
+                                rank_eta=rank_eta)
+            if on_estimation is not None:
+                on_estimation(data)
+
+        async def on_send_data(text):
+            nonlocal frame
+            log("Received send_data message.")
+            if frame is None:
+                # Encode images off the event loop so other jobs keep running
+                encode_started = time.monotonic()
+                frame = await asyncio.to_thread(encode_frame)
+                end_phase("encode", encode_started)
+            # Write the prebuilt JSON bytes as a text frame without an intermediate str
+            await ws.send_frame(frame, aiohttp.WSMsgType.TEXT)
+
+        async def on_process_starts(text):
+            log("Process has started.")
+            seconds = max(process_timeout, deadlines["process_estimate"] or 0)
+            deadlines["current"] = loop.time() + seconds
+            progress.update(phase="processing", seconds=round(seconds, 1))
+            marks["process_started"] = end_phase("queue_wait", marks["queued"])
+            if on_state is not None:
+                on_state("processing")
+
+        async def on_process_completed(text):
+            log("Process completed.")
+            end_phase("process", marks["process_started"])
+            # The image stays a span of the frame text rather than a new multi-MB string
+            data = parse_frame(protocol.parse_message, text)
+            output = data.get('output') or {}
+            if not data.get('success', False):
+                error = output.get('error') or "No error message provided by server."
+                return "failed", f"Server reported failure: {error}", "process"
+            output_data = output.get('data')
+            if not output_data:
+                return "failed", "No output data received.", "output"
+            download_started = time.monotonic()
+            error = await save_output(output_data[0])
+            end_phase("download", download_started)
+            return ("done", None, None) if error is None else ("failed", error, "output")
+
+        async def on_queue_full(text):
+            log("The queue is full. Please try again later.")
+            return "queue_full", "The queue is full.", "queue_full"
+
+        async def on_error(text):
+            error_message = parse_frame(protocol.parse_message, text).get('error', 'Unknown error')
+            log("Error from server: %s", error_message)
+            return "failed", f"Error from server: {error_message}", "server_error"
+
+        # Messages each phase accepts; anything else is logged and skipped without parsing
+        anytime = {"estimation": on_estimation_message, "queue_full": on_queue_full, "error": on_error}
+        handlers = {
+            "joining": dict(anytime, send_hash=on_send_hash),
+            "queued": dict(anytime, send_data=on_send_data, process_starts=on_process_starts,
+                           process_completed=on_process_completed),
+            "processing": dict(anytime, send_data=on_send_data, process_completed=on_process_completed),
+        }
+
+        while True:
+            deadline = deadlines["current"]
+            timeout = None if deadline is None else deadline - loop.time()
+            if timeout is not None and timeout <= 0:
+                raise asyncio.TimeoutError()
+            message = await asyncio.wait_for(ws.receive(), timeout)
+
+            if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED):
+                return "failed", "WebSocket closed before the process completed.", "connection"
+            if message.type == aiohttp.WSMsgType.ERROR:
+                return "failed", f"WebSocket error: {ws.exception()}", "connection"
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+
+            msg_type = protocol.message_type(message.data)
+            handler = handlers[progress["phase"]].get(msg_type)
+            if handler is None:
+                log("Skipped %s message while %s (%d bytes).", msg_type, progress["phase"], len(message.data))
+                continue
+            try:
+                outcome = await handler(message.data)
+            except MalformedMessage:
+                logger.warning("Received non-JSON %s message (%d bytes).", msg_type, len(message.data))
+                continue
+            if outcome is not None:
+                return outcome
+
+    async def upload_inputs():
+        # Upload before joining the queue so no queue slot is held while bytes are in transit
+        uploaded = []
+        for value in (source, target):
+            digest = await input_digest(value, input_cache)
+            path = getattr(value, 'path', value)
+            uploaded.append((digest, await upload_refs.get_reference(http, base_url, path, digest)))
+        return uploaded
+
+    ws = None
+    try:
+        if upload_refs is not None:
+            phase_started = time.monotonic()
+            references = await upload_inputs()
+            end_phase("upload", phase_started)
+            if on_state is not None:
+                on_state("uploaded")
+        phase_started = time.monotonic()
+        ws = await asyncio.wait_for(
+            http.ws_connect(websocket_url or WEBSOCKET_URL, headers={'Cookie': cookie_header}, max_msg_size=0,
+                            compress=compress),
+            connect_timeout)
+        end_phase("connect", phase_started)
+        # The window bits the server agreed to, or 0 when it declined compression
+        result["compress"] = ws.compress
+        log("WebSocket connection opened (compression %s).", ws.compress or "off")
+        result["status"], result["error"], result["error_type"] = await run_protocol(ws)
+    except asyncio.TimeoutError:
+        if ws is None:
+            result["status"], result["error"] = "failed", f"WebSocket did not connect within {connect_timeout} seconds."
+            result["error_type"] = "connection"
+        elif progress["phase"] != "processing":
+            result["status"], result["error"] = "timeout", f"Process did not start within {progress['seconds']} seconds."
+            result["error_type"] = "queue_timeout"
+        else:
+            result["status"], result["error"] = "timeout", f"Process did not complete within {progress['seconds']} seconds."
+            result["error_type"] = "timeout"
+    except aiohttp.WSServerHandshakeError as e:
+        # 401/403 means the session cookies went stale; FusionSession refreshes them and retries
+        status = "unauthorized" if e.status in (401, 403) else "failed"
+        result["status"], result["error"] = status, f"WebSocket handshake failed: {e.status} {e.message}"
+        result["error_type"] = "handshake"
+    except UploadError as e:
+        result["status"], result["error"] = "unauthorized" if e.status in (401, 403) else "failed", str(e)
+        result["error_type"] = "upload"
+    except aiohttp.ClientError as e:
+        result["status"], result["error"] = "failed", f"WebSocket error: {e}"
+        result["error_type"] = "connection"
+    finally:
+        if ws is not None:
+            await ws.close()
+    if references is not None and result["status"] == "failed":
+        # The server may have cleaned up its temporary files; upload again next time
+        for digest, reference in references:
+            upload_refs.invalidate(base_url, digest)
+    if result_cache is not None and result["status"] == "done":
+        source_hash = await input_digest(source, input_cache)
+        target_hash = await input_digest(target, input_cache)
+        await asyncio.to_thread(result_cache.store, source_hash, target_hash, fn_index, output_path)
+    result["elapsed"] = round(time.monotonic() - started, 3)
+    if result["error"]:
+        log("%s", result["error"])
+    return result
+
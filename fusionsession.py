@@ -0,0 +1,184 @@
+import asyncio
+import time
+
+import fusionengine
+
+# Re-fetch the app page after this many seconds even if the cookies have not expired
+COOKIE_TTL = 30 * 60
+
+
+class FusionSession:
+    # A reusable client: one pooled HTTP session, cookies bootstrapped once and refreshed only when
+    # they expire or the server answers 401/403, and the caches shared by every job it runs.
+    # Use as "async with FusionSession(...) as session: await session.fuse(source, target, output)".
+
+    def __init__(self, app_url=None, websocket_url=None, concurrency=100, fn_index=fusionengine.FN_INDEX,
+                 process_timeout=fusionengine.PROCESS_TIMEOUT, connect_timeout=fusionengine.CONNECT_TIMEOUT,
+                 queue_timeout=None, eta_scale=None,
+                 input_cache=None, upload_refs=None, result_cache=None, preprocessor=None, cookie_ttl=COOKIE_TTL,
+                 telemetry=None, compress=0, transcoder=None, verbose=False):
+        self.app_url = app_url or fusionengine.APP_URL
+        self.websocket_url = websocket_url or fusionengine.WEBSOCKET_URL
+        self.concurrency = concurrency
+        self.fn_index = fn_index
+        self.process_timeout = process_timeout
+        self.connect_timeout = connect_timeout
+        self.queue_timeout = queue_timeout
+        self.eta_scale = eta_scale
+        self.input_cache = input_cache
+        self.upload_refs = upload_refs
+        self.result_cache = result_cache
+        self.preprocessor = preprocessor
+        self.cookie_ttl = cookie_ttl
+        self.telemetry = telemetry  # A telemetry.Telemetry recording spans and metrics per job
+        self.compress = compress  # permessage-deflate window bits offered; 0 disables
+        self.transcoder = transcoder  # An outputformat.Transcoder bringing outputs into the wanted format
+        self.verbose = verbose
+        self.http = None
+        self.cookies = None
+        self.cookies_expire_at = 0.0
+        self.bootstraps = 0
+        self.bootstrap_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        if self.http is None:
+            self.http = fusionengine.create_http_session(self.concurrency)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def cookies_valid(self):
+        if self.cookies is None or time.monotonic() >= self.cookies_expire_at:
+            return False
+        # The jar drops cookies once their Expires/Max-Age passes
+        live = {cookie.key for cookie in self.http.cookie_jar}
+        return all(key in live for key in self.cookies)
+
+    async def ensure_cookies(self, force=False):
+        # Returns (cookies, seconds spent bootstrapping); concurrent callers share one bootstrap
+        if not force and self.cookies_valid():
+            return self.cookies, 0.0
+        stale = self.cookies
+        async with self.bootstrap_lock:
+            if self.cookies is not stale and self.cookies_valid():
+                # Another job refreshed them while we waited
+                return self.cookies, 0.0
+            await self.start()
+            started = time.monotonic()
+            if force:
+                self.http.cookie_jar.clear()
+            self.cookies = await fusionengine.bootstrap_session(self.http, self.app_url)
+            self.cookies_expire_at = time.monotonic() + self.cookie_ttl
+            self.bootstraps += 1
+            return self.cookies, time.monotonic() - started
+
+    async def prepare(self, source, target):
+        # Run the optional pre-processing stage; the caches are keyed on the processed inputs
+        if self.preprocessor is None:
+            return source, target
+        return await asyncio.gather(self.preprocessor.prepare(source, 'source'),
+                                    self.preprocessor.prepare(target, 'target'))
+
+    async def restore_cached(self, source, target, output_path='fused_image.png', fn_index=None):
+        # Result-cache lookup without any network work; None on a miss or when no cache is configured
+        if self.result_cache is None:
+            return None
+        prepared_source, prepared_target = await self.prepare(source, target)
+        result = await fusionengine.restore_cached_result(
+            self.result_cache, prepared_source, prepared_target, output_path, fn_index or self.fn_index,
+            self.input_cache)
+        if result is not None:
+            result.update(source=getattr(source, 'path', source), target=getattr(target, 'path', target))
+            await self.convert_output(result, output_path)
+            if self.telemetry is not None:
+                self.telemetry.record_cached()
+        return result
+
+    async def convert_output(self, result, output_path):
+        # Transcode a finished output when a format was asked for; the result cache keeps what the
+        # server sent, so a later run asking for another format still hits it
+        if self.transcoder is None or result["status"] != "done":
+            return
+        info = await self.transcoder.convert(output_path)
+        result.update(output_format=info["format"], output_bytes=info["bytes"])
+
+    async def fuse(self, source, target, output_path='fused_image.png', check_cache=True, **overrides):
+        # Fuse one pair and return its result record, with a per-phase latency breakdown in "timings".
+        # Pass check_cache=False when the caller already called restore_cached().
+        fn_index = overrides.pop('fn_index', self.fn_index)
+        if check_cache:
+            cached = await self.restore_cached(source, target, output_path, fn_index)
+            if cached is not None:
+                return cached
+
+        options = dict(
+            app_url=self.app_url, websocket_url=self.websocket_url, fn_index=fn_index,
+            process_timeout=self.process_timeout, connect_timeout=self.connect_timeout,
+            queue_timeout=self.queue_timeout, eta_scale=self.eta_scale, input_cache=self.input_cache,
+            upload_refs=self.upload_refs, result_cache=self.result_cache, compress=self.compress,
+            verbose=self.verbose)
+        if self.transcoder is not None:
+            options["accept"] = self.transcoder.output_format.accept_header()
+        options.update(overrides)
+
+        trace = None
+        if self.telemetry is not None:
+            trace = self.telemetry.start_job(getattr(source, 'path', source), getattr(target, 'path', target),
+                                             self.app_url)
+            options["trace"] = trace
+        outcome = {"status": "failed", "error_type": "exception"}
+        try:
+            outcome = await self.run_attempts(source, target, output_path, options, trace)
+            return outcome
+        except asyncio.CancelledError:
+            outcome = {"status": "cancelled"}
+            raise
+        finally:
+            if trace is not None:
+                self.telemetry.finish_job(trace, outcome)
+
+    async def run_attempts(self, source, target, output_path, options, trace):
+        # Pre-process, make sure the cookies are fresh, and run the job (again once after a 401/403)
+        started = time.monotonic()
+        prepared_source, prepared_target = await self.prepare(source, target)
+        prepare_time = time.monotonic() - started
+        if trace is not None and self.preprocessor is not None:
+            trace.add_span("preprocess", started, started + prepare_time)
+
+        phase_started = time.monotonic()
+        cookies, bootstrap_time = await self.ensure_cookies()
+        if trace is not None and bootstrap_time:
+            trace.add_span("bootstrap", phase_started, time.monotonic())
+        result = await fusionengine.run_fusion(
+            self.http, cookies, prepared_source, prepared_target, output_path, **options)
+        if result["status"] == "unauthorized":
+            # Stale session: bootstrap again and retry once
+            if trace is not None:
+                trace.add_event("cookie_refresh")
+            phase_started = time.monotonic()
+            cookies, refresh_time = await self.ensure_cookies(force=True)
+            bootstrap_time += refresh_time
+            if trace is not None:
+                trace.add_span("bootstrap", phase_started, time.monotonic())
+            result = await fusionengine.run_fusion(
+                self.http, cookies, prepared_source, prepared_target, output_path, **options)
+        result.update(source=getattr(source, 'path', source), target=getattr(target, 'path', target))
+        result["timings"]["bootstrap"] = round(bootstrap_time, 4)
+        if self.preprocessor is not None:
+            result["timings"]["preprocess"] = round(prepare_time, 4)
+        if self.transcoder is not None and result["status"] == "done":
+            phase_started = time.monotonic()
+            await self.convert_output(result, output_path)
+            result["timings"]["transcode"] = round(time.monotonic() - phase_started, 4)
+            if trace is not None:
+                trace.add_span("transcode", phase_started, time.monotonic())
+        return result
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+from batchfusion import add_session_arguments, build_session, parse_weights, release_session
+from coalescer import CoalescingSession
+from fairqueue import CLASS_WEIGHTS, FairQueue
+from retrypolicy import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Long-running worker: builds one session (connections, cookies, caches, pre-processing pool) at
+# startup and serves jobs until stopped, so per-image cost is only the job itself.
+#
+# Directory mode (--watch DIR): drop {"source": ..., "target": ..., "output": ...} JSON files into
+# DIR/inbox (write elsewhere and rename in). A worker claims a file by renaming it into
+# DIR/processing/<host>-<pid>/, so several workers can share a directory, and writes the result
+# record to DIR/done/ or DIR/failed/. "output" defaults to DIR/outbox/<job name>.png.
+#
+# Socket mode (--socket PATH): send one JSON job per line over a Unix socket; each job is answered
+# with its result record on one line (with the job's "id", if given) as soon as it finishes.
+#
+# Jobs may carry "priority" (interactive, standard or bulk), "tenant" and "deadline" (seconds from
+# receipt). They wait in a fair queue, so interactive jobs are not stuck behind bulk ones and each
+# tenant gets its weighted share; this matters most in socket mode, where any number of jobs can be
+# pending, since directory mode only claims as many jobs as it can run.
+
+# Seconds between scans of the inbox
+POLL_INTERVAL = 0.5
+
+# Number of queue sessions kept in flight
+DEFAULT_CONCURRENCY = 4
+
+
+class FusionWorker:
+    def __init__(self, session, concurrency=DEFAULT_CONCURRENCY, retry_policy=None, tenant_weights=None):
+        self.session = session
+        self.concurrency = concurrency
+        self.queue = FairQueue(concurrency, tenant_weights=tenant_weights)
+        if session.telemetry is not None:
+            session.telemetry.attach_queue(self.queue)
+        self.retry_policy = retry_policy
+        self.stopping = asyncio.Event()
+        self.tasks = set()
+        self.completed = 0
+        self.failed = 0
+
+    async def fuse(self, job):
+        # Run one job and return its result record; never raises for a failed job
+        for key in ('source', 'target'):
+            if not job.get(key) or not os.path.isfile(job[key]):
+                return dict(job, status="failed", error=f"Image file {job.get(key)} does not exist.")
+        if job.get('priority') is not None and job['priority'] not in CLASS_WEIGHTS:
+            return dict(job, status="failed", error=f"Unknown priority {job['priority']!r}.")
+        deadline = job.get('deadline')
+        if deadline is not None and not isinstance(deadline, (int, float)):
+            return dict(job, status="failed", error="deadline must be a number of seconds.")
+        received = time.monotonic()
+        output_dir = os.path.dirname(job['output'])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        async def run(on_estimation):
+            try:
+                return await self.session.fuse(job['source'], job['target'], job['output'],
+                                               on_estimation=on_estimation)
+            except Exception as e:
+                return dict(job, status="failed", error=f"{type(e).__name__}: {e}")
+
+        def admit(run):
+            # Retries count against the same deadline
+            remaining = None if deadline is None else deadline - (time.monotonic() - received)
+            return self.queue.submit(run, job.get('priority'), job.get('tenant'), remaining, record=job)
+
+        async def attempt():
+            if isinstance(self.session, CoalescingSession):
+                # Coalesce before queueing, so identical jobs take one slot rather than one each
+                try:
+                    return await self.session.fuse(job['source'], job['target'], job['output'], admit=admit)
+                except Exception as e:
+                    return dict(job, status="failed", error=f"{type(e).__name__}: {e}")
+            return await admit(run)
+
+        if self.retry_policy is not None:
+            result = await self.retry_policy.run(attempt)
+        else:
+            result = await attempt()
+        if result['status'] == 'done':
+            self.completed += 1
+        else:
+            self.failed += 1
+        if 'id' in job:
+            result['id'] = job['id']
+        return result
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def watch(self, directory):
+        inbox, outbox = os.path.join(directory, 'inbox'), os.path.join(directory, 'outbox')
+        processing = os.path.join(directory, 'processing')
+        claimed = os.path.join(processing, f"{socket.gethostname()}-{os.getpid()}")
+        for path in (inbox, outbox, claimed, os.path.join(directory, 'done'), os.path.join(directory, 'failed')):
+            os.makedirs(path, exist_ok=True)
+        self.requeue_abandoned(inbox, processing, claimed)
+        logger.info("Watching %s", inbox)
+
+        while not self.stopping.is_set():
+            # Claim only as many jobs as can run, so idle workers sharing the directory get the rest
+            names = [name for name in sorted(os.listdir(inbox)) if name.endswith('.json')]
+            for name in names[:max(0, self.concurrency - len(self.tasks))]:
+                path = os.path.join(claimed, name)
+                try:
+                    os.rename(os.path.join(inbox, name), path)
+                except OSError:
+                    continue  # Another worker claimed it first
+                self.spawn(self.run_file(directory, path, outbox))
+            try:
+                await asyncio.wait_for(self.stopping.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def requeue_abandoned(self, inbox, processing, claimed):
+        # Jobs claimed by workers on this host that are no longer running go back to the inbox
+        prefix = f"{socket.gethostname()}-"
+        for owner in os.listdir(processing):
+            owner_dir = os.path.join(processing, owner)
+            pid = owner[len(prefix):]
+            if owner_dir == claimed or not owner.startswith(prefix) or not pid.isdigit() or process_alive(int(pid)):
+                continue
+            for name in os.listdir(owner_dir):
+                os.rename(os.path.join(owner_dir, name), os.path.join(inbox, name))
+                logger.info("Re-queued %s from stopped worker %s", name, pid)
+            os.rmdir(owner_dir)
+
+    async def run_file(self, directory, path, outbox):
+        name = os.path.basename(path)
+        try:
+            with open(path) as f:
+                job = json.load(f)
+            job.setdefault('output', os.path.join(outbox, os.path.splitext(name)[0] + '.png'))
+        except (OSError, ValueError) as e:
+            result = {"status": "failed", "error": f"Unreadable job file: {e}"}
+        else:
+            result = await self.fuse(job)
+        status_dir = os.path.join(directory, 'done' if result['status'] == 'done' else 'failed')
+        # Write then rename, so whoever waits on done/ never reads a partial record
+        partial = os.path.join(status_dir, name + '.part')
+        with open(partial, 'w') as f:
+            json.dump(result, f)
+        os.replace(partial, os.path.join(status_dir, name))
+        os.remove(path)
+        logger.info("%s: %s", name, result['status'])
+
+    async def serve_socket(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle_connection, path=path, limit=2 ** 20)
+        logger.info("Listening on %s", path)
+        try:
+            await self.stopping.wait()
+        finally:
+            # Stop accepting; jobs already received still finish in drain()
+            server.close()
+            os.remove(path)
+
+    async def handle_connection(self, reader, writer):
+        # Jobs from one connection run concurrently; answers are written as each one finishes
+        write_lock = asyncio.Lock()
+
+        async def answer(job):
+            result = await self.fuse(job)
+            async with write_lock:
+                writer.write((json.dumps(result) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        pending = set()
+        try:
+            while not self.stopping.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    job = json.loads(line)
+                    if not isinstance(job, dict):
+                        raise ValueError("a job must be a JSON object")
+                except ValueError as e:
+                    async with write_lock:
+                        writer.write((json.dumps({"status": "failed", "error": f"Bad request: {e}"}) + '\n').encode())
+                    continue
+                job.setdefault('output', os.path.splitext(job.get('target') or 'job')[0] + '_fused.png')
+                task = self.spawn(answer(job))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def drain(self):
+        # Let in-flight jobs finish after a stop request
+        if self.tasks:
+            logger.info("Finishing %d in-flight job(s)", len(self.tasks))
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+async def run_worker(session, args):
+    worker = FusionWorker(session, args.concurrency,
+                          RetryPolicy(max_attempts=args.attempts) if args.attempts > 1 else None,
+                          tenant_weights=args.tenant_weights)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stopping.set)
+    if session.telemetry is not None and args.metrics_port:
+        await session.telemetry.serve(port=args.metrics_port)
+    try:
+        async with session:
+            # Bootstrap up front so a bad configuration fails at startup, not on the first job
+            await session.ensure_cookies()
+            if args.watch:
+                await worker.watch(args.watch)
+            else:
+                await worker.serve_socket(args.socket)
+            await worker.drain()
+    finally:
+        if session.telemetry is not None:
+            await session.telemetry.stop_serving()
+    print(f"Stopped after {worker.completed} completed and {worker.failed} failed job(s).")
+    print(f"Queue: {json.dumps(worker.queue.stats())}")
+    if isinstance(session, CoalescingSession):
+        print(f"Coalescing: {json.dumps(session.stats())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fusion jobs from a watched directory or a Unix socket.")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--watch', help="Job directory with inbox/, processing/, done/, failed/ and outbox/")
+    mode.add_argument('--socket', help="Unix socket path accepting one JSON job per line")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of queue sessions kept in flight")
+    parser.add_argument('--tenant-weight', action='append', default=[], metavar='TENANT=WEIGHT',
+                        help="A tenant's share relative to others in its priority class (default 1)")
+    add_session_arguments(parser)
+    parser.set_defaults(log_level='INFO')
+    args = parser.parse_args()
+    args.tenant_weights = parse_weights(parser, args.tenant_weight)
+
+    session = build_session(parser, args)
+    try:
+        asyncio.run(run_worker(session, args))
+    finally:
+        release_session(session, args)
+
+
+if __name__ == "__main__":
+    main()
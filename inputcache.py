@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from payloadencoding import EncodedInput, encode_data_url, sniff_mime
+
+# Default in-memory budget for encoded data URLs
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Default on-disk budget for spilled data URLs
+DEFAULT_SPILL_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+class EncodedInputCache:
+    # LRU cache of ready-to-send data URLs, bounded by the total size of the encoded bytes.
+    # Entries are keyed by content hash so the same face under different paths is encoded once;
+    # a (path, size, mtime) index lets repeated lookups skip reading and hashing the file.
+    # With spill_dir set, every encoded entry is also written to disk so a restarted worker starts warm;
+    # once the spilled files exceed spill_max_bytes the least recently used ones are deleted, and
+    # index.jsonl is rewritten without their paths when it has grown to twice what is still on disk.
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None, spill_max_bytes=DEFAULT_SPILL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_files = OrderedDict()  # file name -> size, least recently used first
+        self.spill_bytes = 0
+        self.spill_evictions = 0
+        self.index_lines = 0
+        self.entries = OrderedDict()
+        self.hash_index = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+        self.lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.load_spill_files()
+            self.load_spill_index()
+
+    def stat_key(self, path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def content_hash(self, path):
+        # Hash the file unless this exact (path, size, mtime) was hashed before
+        key = self.stat_key(path)
+        with self.lock:
+            digest = self.hash_index.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self.lock:
+                self.hash_index[key] = digest
+        return digest
+
+    def get(self, path, mime=None):
+        entry_key = (self.content_hash(path), mime or sniff_mime(path))
+        with self.lock:
+            data_url = self.entries.get(entry_key)
+            if data_url is not None:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return EncodedInput(path, data_url, digest=entry_key[0])
+            self.misses += 1
+
+        data_url = self.read_spill(entry_key)
+        if data_url is not None:
+            with self.lock:
+                self.spill_hits += 1
+        else:
+            data_url = encode_data_url(path, mime)
+            self.write_spill(entry_key, data_url, path)
+        self.put(entry_key, data_url)
+        return EncodedInput(path, data_url, digest=entry_key[0])
+
+    def put(self, entry_key, data_url):
+        size = len(data_url)
+        if size > self.max_bytes:
+            # Larger than the whole budget; hand it out without caching
+            return
+        with self.lock:
+            if entry_key in self.entries:
+                return
+            self.entries[entry_key] = data_url
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "spill_hits": self.spill_hits,
+                "evictions": self.evictions,
+                "spill_evictions": self.spill_evictions,
+                "spill_bytes": self.spill_bytes,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    # On-disk spill
+
+    def spill_name(self, entry_key):
+        digest, mime = entry_key
+        return f"{digest}.{mime.replace('/', '_')}.b64"
+
+    def read_spill(self, entry_key):
+        if not self.spill_dir:
+            return None
+        name = self.spill_name(entry_key)
+        path = os.path.join(self.spill_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                data_url = f.read()
+        except FileNotFoundError:
+            return None
+        # The file's mtime carries its recency over to the next run
+        os.utime(path)
+        with self.lock:
+            if name in self.spill_files:
+                self.spill_files.move_to_end(name)
+        return data_url
+
+    def write_spill(self, entry_key, data_url, source_path):
+        if not self.spill_dir or len(data_url) > self.spill_max_bytes:
+            return
+        name = self.spill_name(entry_key)
+        path = os.path.join(self.spill_dir, name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data_url)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.spill_bytes += len(data_url) - self.spill_files.pop(name, 0)
+            self.spill_files[name] = len(data_url)
+            while self.spill_bytes > self.spill_max_bytes:
+                evicted, size = self.spill_files.popitem(last=False)
+                self.spill_bytes -= size
+                self.spill_evictions += 1
+                try:
+                    os.remove(os.path.join(self.spill_dir, evicted))
+                except FileNotFoundError:
+                    pass
+        self.append_spill_index(self.stat_key(source_path), entry_key[0])
+
+    def load_spill_files(self):
+        # Spilled files from previous runs, oldest use first
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith('.b64') and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        for mtime_ns, name, size in sorted(files):
+            self.spill_files[name] = size
+            self.spill_bytes += size
+
+    def spilled_digests(self):
+        # Called with the lock held
+        return {name.split('.', 1)[0] for name in self.spill_files}
+
+    def load_spill_index(self):
+        # Restore the (path, size, mtime) -> content hash index written by previous runs, keeping
+        # only paths whose encoding is still on disk
+        index_path = os.path.join(self.spill_dir, 'index.jsonl')
+        if not os.path.isfile(index_path):
+            return
+        digests = self.spilled_digests()
+        with open(index_path) as f:
+            for line in f:
+                self.index_lines += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash; the rest of the index is still usable
+                    continue
+                if record['sha256'] in digests:
+                    self.hash_index[(record['path'], record['size'], record['mtime_ns'])] = record['sha256']
+        if self.index_lines > len(self.hash_index):
+            with self.lock:
+                self.compact_spill_index()
+
+    def append_spill_index(self, key, digest):
+        path, size, mtime_ns = key
+        record = {"path": path, "size": size, "mtime_ns": mtime_ns, "sha256": digest}
+        with self.lock:
+            with open(os.path.join(self.spill_dir, 'index.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.index_lines += 1
+            if self.index_lines > 2 * len(self.spill_files) + 1000:
+                self.compact_spill_index()
+
+    def compact_spill_index(self):
+        # Called with the lock held. Rewrites the index with only the paths of spilled encodings.
+        digests = self.spilled_digests()
+        index_path = os.path.join(self.spill_dir, 'index.jsonl')
+        temp_path = f"{index_path}.{threading.get_ident()}.tmp"
+        lines = 0
+        with open(temp_path, 'w') as f:
+            for (path, size, mtime_ns), digest in self.hash_index.items():
+                if digest in digests:
+                    f.write(json.dumps({"path": path, "size": size, "mtime_ns": mtime_ns, "sha256": digest}) + '\n')
+                    lines += 1
+        os.replace(temp_path, index_path)
+        self.index_lines = lines
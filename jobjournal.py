@@ -0,0 +1,170 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Job states, in the order a job moves through them
+QUEUED = 'queued'
+UPLOADED = 'uploaded'
+SUBMITTED = 'submitted'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (QUEUED, UPLOADED, SUBMITTED, PROCESSING, DONE, FAILED)
+
+# States that mean the job was in flight when the process stopped
+IN_FLIGHT = (UPLOADED, SUBMITTED, PROCESSING)
+
+
+def job_key(job):
+    # Jobs are identified by their (source, target, output) triple as written in the manifest
+    text = json.dumps([job['source'], job['target'], job['output']])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class JobJournal:
+    # Crash-safe record of a batch run in SQLite (WAL mode): an append-only "events" log of every
+    # state change plus a "jobs" table holding each job's latest state, output and error.
+    # Both are written in one transaction per change, so a killed process loses at most the change
+    # it was making. On restart, pending() returns only the jobs that still need the GPU.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL survives process crashes; only a power loss can drop the last commits
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                target TEXT NOT NULL,
+                output TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                error_type TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                at REAL NOT NULL,
+                detail TEXT
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.db.commit()
+
+    def pending(self, jobs, retry_failed=True):
+        # Register new jobs as queued and return the ones still to run, in manifest order.
+        # Done jobs whose output has gone missing run again; jobs left in flight by a crash are
+        # re-queued; failed jobs are retried unless retry_failed is False. A row repeating an earlier
+        # one (same source, target and output) is the same job and runs once.
+        now = time.time()
+        remaining = []
+        seen = set()
+        with self.lock:
+            rows = dict(self.db.execute("SELECT job_id, state FROM jobs"))
+            for job in jobs:
+                job_id = job_key(job)
+                if job_id in seen:
+                    continue
+                seen.add(job_id)
+                state = rows.get(job_id)
+                if state is None:
+                    self.db.execute(
+                        "INSERT INTO jobs (job_id, source, target, output, state, created, updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, job['source'], job['target'], job['output'], QUEUED, now, now))
+                    self.db.execute("INSERT INTO events (job_id, state, at) VALUES (?, ?, ?)",
+                                    (job_id, QUEUED, now))
+                    remaining.append(job)
+                    continue
+                if state == DONE and os.path.isfile(job['output']):
+                    continue
+                if state == FAILED and not retry_failed:
+                    continue
+                if state != QUEUED:
+                    detail = "output missing" if state == DONE else f"resumed from {state}"
+                    self.db.execute("UPDATE jobs SET state = ?, updated = ? WHERE job_id = ?", (QUEUED, now, job_id))
+                    self.db.execute("INSERT INTO events (job_id, state, at, detail) VALUES (?, ?, ?, ?)",
+                                    (job_id, QUEUED, now, detail))
+                remaining.append(job)
+            self.db.commit()
+        return remaining
+
+    def record(self, job, state, detail=None):
+        # Record an intermediate state (uploaded, submitted, processing)
+        job_id = job_key(job)
+        now = time.time()
+        with self.lock:
+            if state == SUBMITTED:
+                self.db.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                                (state, now, job_id))
+            else:
+                self.db.execute("UPDATE jobs SET state = ?, updated = ? WHERE job_id = ?", (state, now, job_id))
+            self.db.execute("INSERT INTO events (job_id, state, at, detail) VALUES (?, ?, ?, ?)",
+                            (job_id, state, now, detail))
+            self.db.commit()
+
+    def finish(self, job, result):
+        # Record the final outcome from a result record
+        job_id = job_key(job)
+        state = DONE if result.get('status') == 'done' else FAILED
+        now = time.time()
+        detail = 'cached' if result.get('cached') else result.get('status')
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = ?, error = ?, error_type = ?, updated = ? WHERE job_id = ?",
+                            (state, result.get('error'), result.get('error_type'), now, job_id))
+            self.db.execute("INSERT INTO events (job_id, state, at, detail) VALUES (?, ?, ?, ?)",
+                            (job_id, state, now, detail))
+            self.db.commit()
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def failures(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT source, target, output, error_type, error, attempts FROM jobs WHERE state = ? ORDER BY updated",
+                (FAILED,)).fetchall()
+        keys = ('source', 'target', 'output', 'error_type', 'error', 'attempts')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a batch job journal.")
+    parser.add_argument('journal', help="Journal file written by batchfusion.py --journal")
+    parser.add_argument('action', choices=['stats', 'failed'])
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.journal):
+        parser.error(f"{args.journal} does not exist.")
+    journal = JobJournal(args.journal)
+    try:
+        if args.action == 'stats':
+            print(json.dumps(journal.counts()))
+        else:
+            for failure in journal.failures():
+                print(json.dumps(failure))
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import asyncio
+import time
+import urllib.parse
+
+import aiohttp
+
+from fusionengine import BootstrapError, new_result
+from fusionsession import FusionSession
+from retrypolicy import RetryPolicy
+
+# Seconds between health checks of every endpoint
+HEALTH_INTERVAL = 10.0
+
+# Seconds an endpoint stays out of rotation after an error or timeout
+EJECT_DURATION = 30.0
+
+# Failures of these kinds point at the endpoint rather than the job: it is ejected and its jobs move elsewhere
+ENDPOINT_FAILURES = {'connection', 'handshake'}
+
+# Retryable per-job failures (transient server errors, processing timeouts) move only that job, and
+# eject the endpoint only after this many in a row
+EJECT_AFTER_FAILURES = 3
+
+
+def websocket_url_for(app_url):
+    # Derive the /queue/join URL from an app URL: http(s) -> ws(s)
+    parts = urllib.parse.urlsplit(app_url)
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    return urllib.parse.urlunsplit((scheme, parts.netloc, parts.path.rstrip('/') + '/queue/join', '', ''))
+
+
+def parse_endpoint(value):
+    # "APP_URL" or "APP_URL,WEBSOCKET_URL"
+    app_url, _, websocket_url = value.partition(',')
+    return app_url.strip(), (websocket_url.strip() or websocket_url_for(app_url.strip()))
+
+
+class Endpoint:
+    def __init__(self, session):
+        self.session = session
+        self.name = session.app_url
+        self.outstanding = 0
+        self.attempts = set()
+        self.job_time = None  # EWMA of queue wait + process seconds
+        self.rank_eta = 0.0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.completed = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+    def score(self):
+        # Least outstanding requests, weighted by how long a job here is expected to take
+        expected = (self.job_time if self.job_time is not None else 1.0) + self.rank_eta
+        return (self.outstanding + 1) * expected
+
+    def observe(self, result):
+        timings = result.get('timings') or {}
+        if 'process' in timings:
+            sample = timings.get('queue_wait', 0.0) + timings['process']
+            self.job_time = sample if self.job_time is None else 0.8 * self.job_time + 0.2 * sample
+
+    def stats(self):
+        return {
+            "healthy": self.healthy(),
+            "outstanding": self.outstanding,
+            "completed": self.completed,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "job_time": round(self.job_time, 4) if self.job_time is not None else None,
+            "rank_eta": self.rank_eta,
+        }
+
+
+class LoadBalancer:
+    # Spreads jobs over several backends, each with its own FusionSession (cookies and pool) but
+    # sharing the caches. Endpoints that cannot be connected to or fail a health check are ejected
+    # for eject_duration; their in-flight jobs are cancelled there and re-queued on another endpoint.
+    # A job that fails retryably (per retry_policy.is_retryable) moves to another endpoint on its own,
+    # and the endpoint is only ejected, without cancelling its other jobs, after eject_after such
+    # failures in a row; fatal failures such as a bad input are returned as they are.
+    # Offers the same restore_cached()/fuse() interface as FusionSession.
+
+    def __init__(self, endpoints, health_interval=HEALTH_INTERVAL, eject_duration=EJECT_DURATION,
+                 eject_after=EJECT_AFTER_FAILURES, retry_policy=None, **session_options):
+        if not endpoints:
+            raise ValueError("LoadBalancer needs at least one endpoint.")
+        self.endpoints = [Endpoint(FusionSession(app_url, websocket_url, **session_options))
+                          for app_url, websocket_url in endpoints]
+        self.health_interval = health_interval
+        self.eject_duration = eject_duration
+        self.eject_after = eject_after
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.requeued = 0
+        self.health_task = None
+        first = self.endpoints[0].session
+        self.fn_index = first.fn_index
+        self.input_cache = first.input_cache
+        self.upload_refs = first.upload_refs
+        self.result_cache = first.result_cache
+        self.preprocessor = first.preprocessor
+        self.transcoder = first.transcoder
+        # Each attempt is traced as its own job, labelled with the endpoint that ran it
+        self.telemetry = first.telemetry
+
+    @property
+    def bootstraps(self):
+        return sum(endpoint.session.bootstraps for endpoint in self.endpoints)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        for endpoint in self.endpoints:
+            await endpoint.session.start()
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self.health_loop())
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        for endpoint in self.endpoints:
+            await endpoint.session.close()
+
+    async def ensure_cookies(self):
+        # Bootstrap every endpoint; unreachable ones are ejected, and only all failing is an error
+        results = await asyncio.gather(*(endpoint.session.ensure_cookies() for endpoint in self.endpoints),
+                                       return_exceptions=True)
+        for endpoint, outcome in zip(self.endpoints, results):
+            if isinstance(outcome, Exception):
+                self.eject(endpoint)
+        if not any(endpoint.healthy() for endpoint in self.endpoints):
+            raise BootstrapError("No endpoint could be bootstrapped.")
+
+    def eject(self, endpoint, requeue=True):
+        if endpoint.healthy():
+            endpoint.ejections += 1
+        endpoint.ejected_until = time.monotonic() + self.eject_duration
+        endpoint.consecutive_failures = 0
+        if requeue:
+            # The endpoint went away: move its in-flight jobs elsewhere
+            for attempt in list(endpoint.attempts):
+                attempt.cancel()
+
+    async def check_health(self, endpoint):
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.health_interval)
+            async with endpoint.session.http.get(endpoint.session.app_url, timeout=timeout) as response:
+                await response.read()
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        # Ejections expire on their own; a failing check ejects (or keeps ejected) the endpoint
+        if not healthy:
+            self.eject(endpoint)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.check_health(endpoint) for endpoint in self.endpoints))
+
+    async def pick(self, exclude):
+        # Best-scoring healthy endpoint this job has not tried yet, or None. Only a job that has not
+        # run anywhere waits for an ejection to expire, and for at most eject_duration: health checks
+        # keep re-ejecting an endpoint that stays down, so its ejected_until keeps moving forward.
+        give_up = time.monotonic() + self.eject_duration
+        while True:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy() and endpoint not in exclude]
+            if candidates:
+                return min(candidates, key=Endpoint.score)
+            waiting = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            now = time.monotonic()
+            if not waiting or exclude or now >= give_up:
+                return None
+            # Sleep until the first remaining ejection expires
+            await asyncio.sleep(max(0.05, min(min(endpoint.ejected_until for endpoint in waiting), give_up) - now))
+
+    async def restore_cached(self, source, target, output_path='fused_image.png', fn_index=None):
+        return await self.endpoints[0].session.restore_cached(source, target, output_path, fn_index)
+
+    async def fuse(self, source, target, output_path='fused_image.png', check_cache=True, on_estimation=None,
+                   **overrides):
+        if check_cache:
+            cached = await self.restore_cached(source, target, output_path, overrides.get('fn_index'))
+            if cached is not None:
+                return cached
+
+        tried = set()
+        result = None
+        while True:
+            endpoint = await self.pick(tried)
+            if endpoint is None:
+                if result is None:
+                    # No endpoint came back, or every attempt was cut short by an ejection; callers
+                    # still get a record to retry
+                    result = new_result(source, target, output_path)
+                    result.update(status="failed", error="No healthy endpoint left to run the job.",
+                                  error_type="connection")
+                return result
+            tried.add(endpoint)
+
+            def record_estimation(data, endpoint=endpoint):
+                rank_eta = data.get('rank_eta')
+                if isinstance(rank_eta, (int, float)):
+                    endpoint.rank_eta = rank_eta
+                if on_estimation is not None:
+                    on_estimation(data)
+
+            attempt = asyncio.create_task(endpoint.session.fuse(
+                source, target, output_path, check_cache=False, on_estimation=record_estimation, **overrides))
+            endpoint.attempts.add(attempt)
+            endpoint.outstanding += 1
+            try:
+                result = await attempt
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # Cancelled by eject(): the endpoint went away mid-job, so re-queue it
+                self.requeued += 1
+                continue
+            finally:
+                endpoint.attempts.discard(attempt)
+                endpoint.outstanding -= 1
+
+            endpoint.observe(result)
+            if result['status'] == 'done':
+                endpoint.completed += 1
+                endpoint.consecutive_failures = 0
+                return result
+            if result['status'] == 'queue_full' or result.get('error_type') == 'queue_timeout':
+                # Busy rather than broken: try another endpoint without ejecting this one
+                if len(tried) < len(self.endpoints):
+                    continue
+                return result
+            if result.get('error_type') in ENDPOINT_FAILURES:
+                endpoint.failures += 1
+                self.eject(endpoint)
+                self.requeued += 1
+                continue
+            if self.retry_policy.is_retryable(result):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.eject_after:
+                    # Stop sending it new jobs, but let the ones already running there finish
+                    self.eject(endpoint, requeue=False)
+                if len(tried) < len(self.endpoints):
+                    self.requeued += 1
+                    continue
+            return result
+
+    def stats(self):
+        return {
+            "requeued": self.requeued,
+            "endpoints": {endpoint.name: endpoint.stats() for endpoint in self.endpoints},
+        }
@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import base64
+import itertools
+import os
+import random
+import tempfile
+import uuid
+
+from aiohttp import web
+
+# A local stand-in for the Gradio queue used by the fusion client.
+# It speaks the same /queue/join message flow and "fuses" by echoing the target image back
+# (or by returning a synthetic output of a fixed size). Processing is limited to a number of
+# GPU "workers"; waiting jobs receive estimation updates, and failures can be injected at
+# configurable rates for benchmarking the client's error handling.
+
+DEFAULT_PORT = 7860
+
+
+class MockGradioServer:
+    def __init__(self, latency=0.1, output_mode='data', file_dir=None, capacity=None, workers=None,
+                 latency_jitter=0.0, output_size=None, error_rate=0.0, queue_full_rate=0.0, drop_rate=0.0,
+                 stall_rate=0.0, seed=None, compress=True):
+        self.latency = latency
+        self.latency_jitter = latency_jitter  # Processing time is latency +/- up to this many seconds
+        self.capacity = capacity  # Concurrent jobs accepted before answering queue_full
+        self.worker_count = workers  # Jobs processed at once; None processes every job immediately
+        self.workers = asyncio.Semaphore(workers) if workers else None
+        self.output_mode = output_mode  # 'data' returns a data URL, 'file' returns a file reference
+        self.output_size = output_size  # Return this many synthetic bytes instead of echoing the target
+        self.error_rate = error_rate  # Fraction of jobs answered with an "error" message
+        self.queue_full_rate = queue_full_rate  # Fraction of jobs answered with queue_full
+        self.drop_rate = drop_rate  # Fraction of jobs whose socket is closed mid-process
+        self.stall_rate = stall_rate  # Fraction of jobs that never complete
+        self.random = random.Random(seed)
+        self.compress = compress  # Accept permessage-deflate when the client offers it
+        self.file_dir = file_dir or tempfile.mkdtemp(prefix='mockgradio-')
+        self.counter = itertools.count(1)
+        self.active = 0
+        self.waiting = 0
+        self.synthetic_output = None
+        self.stats = {"connections": 0, "completed": 0, "uploads": 0, "queue_full": 0,
+                      "errors": 0, "dropped": 0, "stalled": 0}
+
+    def make_app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/', self.handle_index)
+        app.router.add_get('/queue/join', self.handle_queue_join)
+        app.router.add_get('/file={name:.+}', self.handle_file)
+        app.router.add_post('/upload', self.handle_upload)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.stats, active=self.active, waiting=self.waiting))
+
+    async def handle_index(self, request):
+        response = web.Response(text='<html>mock gradio</html>', content_type='text/html')
+        if 'session_id' not in request.cookies:
+            response.set_cookie('session_id', uuid.uuid4().hex)
+        return response
+
+    async def handle_file(self, request):
+        path = request.match_info['name']
+        if not os.path.abspath(path).startswith(os.path.abspath(self.file_dir)) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+    async def handle_upload(self, request):
+        # Store each multipart "files" part and return the server-side paths, like Gradio's /upload
+        paths = []
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name != 'files':
+                continue
+            path = os.path.join(self.file_dir, f'upload_{next(self.counter)}_{os.path.basename(part.filename or "file")}')
+            with open(path, 'wb') as f:
+                while chunk := await part.read_chunk():
+                    f.write(chunk)
+            paths.append(path)
+            self.stats["uploads"] += 1
+        return web.json_response(paths)
+
+    def build_output(self, value):
+        # Echo the target input back (or return the synthetic output) in the configured output format
+        if self.output_size:
+            if self.synthetic_output is None:
+                self.synthetic_output = b'\x89PNG\r\n\x1a\n' + os.urandom(max(0, self.output_size - 8))
+            image_bytes = self.synthetic_output
+        elif isinstance(value, dict) and value.get('name'):
+            if not os.path.abspath(value['name']).startswith(os.path.abspath(self.file_dir)):
+                raise FileNotFoundError(value['name'])
+            with open(value['name'], 'rb') as f:
+                image_bytes = f.read()
+        else:
+            header, encoded = value.split(',', 1)
+            image_bytes = base64.b64decode(encoded)
+        if self.output_mode == 'file':
+            path = os.path.join(self.file_dir, f'output_{next(self.counter)}.png')
+            with open(path, 'wb') as f:
+                f.write(image_bytes)
+            return {"name": path, "data": None, "is_file": True}
+        return "data:image/png;base64," + base64.b64encode(image_bytes).decode('utf-8')
+
+    def processing_time(self):
+        return max(0.0, self.latency + self.random.uniform(-self.latency_jitter, self.latency_jitter))
+
+    def rank_eta(self, rank):
+        # Jobs ahead of this one, spread over the workers, plus its own processing time
+        return round(self.latency * (rank / (self.worker_count or 1) + 1), 3)
+
+    async def handle_queue_join(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0, compress=self.compress)
+        await ws.prepare(request)
+        self.stats["connections"] += 1
+        self.active += 1
+        try:
+            await ws.send_json({"msg": "send_hash"})
+            hash_message = await ws.receive_json()
+            fn_index = hash_message.get('fn_index')
+            if ((self.capacity is not None and self.active > self.capacity)
+                    or self.random.random() < self.queue_full_rate):
+                self.stats["queue_full"] += 1
+                await ws.send_json({"msg": "queue_full"})
+                return ws
+
+            # Wait for a worker, sending estimation updates while queued
+            self.waiting += 1
+            try:
+                rank = self.waiting - 1
+                await ws.send_json({"msg": "estimation", "rank": rank, "queue_size": self.waiting,
+                                    "rank_eta": self.rank_eta(rank)})
+                if self.workers:
+                    while True:
+                        try:
+                            await asyncio.wait_for(self.workers.acquire(), self.latency or 0.1)
+                            break
+                        except asyncio.TimeoutError:
+                            rank = max(0, rank - 1)
+                            await ws.send_json({"msg": "estimation", "rank": rank, "queue_size": self.waiting,
+                                                "rank_eta": self.rank_eta(rank)})
+            finally:
+                self.waiting -= 1
+
+            try:
+                await ws.send_json({"msg": "send_data"})
+                data_message = await ws.receive_json()
+                await ws.send_json({"msg": "process_starts"})
+                await self.process(ws, fn_index, data_message)
+            finally:
+                if self.workers:
+                    self.workers.release()
+        finally:
+            self.active -= 1
+            await ws.close()
+        return ws
+
+    async def process(self, ws, fn_index, data_message):
+        # Simulate the GPU work, then answer with the output or an injected failure
+        roll = self.random.random()
+        if roll < self.stall_rate:
+            self.stats["stalled"] += 1
+            await ws.receive()  # Until the client gives up and closes
+            return
+        roll -= self.stall_rate
+        duration = self.processing_time()
+        if roll < self.drop_rate:
+            self.stats["dropped"] += 1
+            await asyncio.sleep(duration / 2)
+            return
+        roll -= self.drop_rate
+        await asyncio.sleep(duration)
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            await ws.send_json({"msg": "error", "error": "Injected failure."})
+            return
+
+        inputs = data_message.get('data') or []
+        if data_message.get('fn_index', fn_index) != fn_index or len(inputs) < 2:
+            await ws.send_json({"msg": "process_completed", "success": False,
+                                "output": {"error": "Unexpected payload."}})
+            return
+        try:
+            output = self.build_output(inputs[1])
+        except (OSError, ValueError) as e:
+            await ws.send_json({"msg": "process_completed", "success": False,
+                                "output": {"error": f"Could not read input: {e}"}})
+            return
+        await ws.send_json({"msg": "process_completed", "success": True,
+                            "output": {"data": [output], "is_generating": False, "duration": duration}})
+        self.stats["completed"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gradio /queue/join server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.1, help="Simulated processing time in seconds")
+    parser.add_argument('--output-mode', choices=['data', 'file'], default='data')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="Processing time varies by +/- this")
+    parser.add_argument('--capacity', type=int, help="Answer queue_full beyond this many concurrent jobs")
+    parser.add_argument('--workers', type=int, help="Jobs processed at once; the rest wait with estimations")
+    parser.add_argument('--output-size', type=int, help="Return synthetic outputs of this many bytes")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of jobs answered with error")
+    parser.add_argument('--queue-full-rate', type=float, default=0.0, help="Fraction answered with queue_full")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of sockets closed mid-process")
+    parser.add_argument('--stall-rate', type=float, default=0.0, help="Fraction of jobs that never complete")
+    parser.add_argument('--seed', type=int, help="Seed for failure injection and jitter")
+    parser.add_argument('--no-compress', action='store_true', help="Decline permessage-deflate")
+    args = parser.parse_args()
+
+    server = MockGradioServer(
+        latency=args.latency, output_mode=args.output_mode, capacity=args.capacity, workers=args.workers,
+        latency_jitter=args.latency_jitter, output_size=args.output_size, error_rate=args.error_rate,
+        queue_full_rate=args.queue_full_rate, drop_rate=args.drop_rate, stall_rate=args.stall_rate,
+        seed=args.seed, compress=not args.no_compress)
+    print(f"APP_URL=http://{args.host}:{args.port}/")
+    print(f"WEBSOCKET_URL=ws://{args.host}:{args.port}/queue/join")
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
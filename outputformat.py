@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from payloadencoding import sniff_mime
+
+# Pillow is needed to transcode outputs; without it (or without WebP support) outputs are kept as
+# the server sent them
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Output formats with their MIME types and file extensions
+OUTPUT_FORMATS = {'png': ('image/png', '.png'), 'webp': ('image/webp', '.webp'), 'jpeg': ('image/jpeg', '.jpg')}
+
+
+class OutputFormat:
+    # The format fused outputs should end up in. quality bounds lossy JPEG/WebP encoding; WebP
+    # without a quality is encoded losslessly.
+    def __init__(self, format='png', quality=None):
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {format!r}; expected one of {sorted(OUTPUT_FORMATS)}")
+        self.format = format
+        self.quality = quality
+
+    @property
+    def mime(self):
+        return OUTPUT_FORMATS[self.format][0]
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.format][1]
+
+    def lossless(self):
+        return self.format == 'png' or (self.format == 'webp' and self.quality is None)
+
+    def accept_header(self):
+        # Preference sent with output downloads: the wanted format first, PNG as the lossless fallback.
+        # Gradio serves files as they are, but a proxy in front of it may negotiate.
+        if self.format == 'png':
+            return 'image/png,image/*;q=0.8'
+        return f'{self.mime},image/png;q=0.8,image/*;q=0.5'
+
+
+def save_as(image, temp_path, format, save_options):
+    try:
+        image.save(temp_path, format=format.upper(), **save_options)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return os.path.getsize(temp_path)
+
+
+def transcode_image(path, output_format):
+    # Runs in a worker process. Re-encodes path in place and returns the format it now holds, which
+    # is always output_format, since the caller named the file for it. When a lossy WebP encode is
+    # not smaller than what arrived (an already small image), the lossless encode is used if it is
+    # smaller than the lossy one, so no quality is given up for nothing.
+    with Image.open(path) as opened:
+        image = opened
+        if output_format.format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        if output_format.format == 'png':
+            save_options = {'optimize': True}
+        elif output_format.lossless():
+            save_options = {'lossless': True, 'method': 4}
+        else:
+            save_options = {'quality': output_format.quality}
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        size = save_as(image, temp_path, output_format.format, save_options)
+        if output_format.format == 'webp' and not output_format.lossless() and size >= os.path.getsize(path):
+            lossless_path = f"{temp_path}.lossless"
+            if save_as(image, lossless_path, 'webp', {'lossless': True, 'method': 4}) < size:
+                os.replace(lossless_path, temp_path)
+            else:
+                os.remove(lossless_path)
+    os.replace(temp_path, path)
+    return output_format.format
+
+
+class Transcoder:
+    # Brings fused outputs into the wanted format on receipt when the server sent another one
+    # (Gradio's image output is always PNG). Runs in a process pool so encoding overlaps with other
+    # jobs' network I/O; the file keeps the output path the caller chose.
+
+    def __init__(self, output_format, workers=None):
+        self.output_format = output_format
+        self.pool = None
+        self.transcoded = 0
+        self.kept = 0
+        self.matched = 0
+        self.bytes_received = 0
+        self.bytes_written = 0
+        self.enabled = Image is not None and (output_format.format != 'webp' or features.check('webp'))
+        if Image is None:
+            print("Pillow is not installed; outputs are kept as the server sends them.")
+        elif not self.enabled:
+            print("Pillow was built without WebP support; outputs are kept as the server sends them.")
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    async def convert(self, path):
+        # Transcode path in place if needed; returns its format and the bytes received and kept
+        received = os.path.getsize(path)
+        mime = await asyncio.to_thread(sniff_mime, path)
+        format = next((name for name, (known, extension) in OUTPUT_FORMATS.items() if known == mime), None)
+        if format == self.output_format.format:
+            self.matched += 1
+        elif self.enabled and format is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                format = await loop.run_in_executor(self.pool, transcode_image, path, self.output_format)
+            except Exception as e:
+                # An output Pillow cannot read is still a valid result; keep it as it arrived
+                logger.warning("Could not transcode %s: %s", path, e)
+            if format == self.output_format.format:
+                self.transcoded += 1
+            else:
+                self.kept += 1
+        else:
+            self.kept += 1
+        written = os.path.getsize(path)
+        self.bytes_received += received
+        self.bytes_written += written
+        return {"format": format, "bytes_received": received, "bytes": written}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def stats(self):
+        return {"format": self.output_format.format, "quality": self.output_format.quality,
+                "transcoded": self.transcoded, "matched": self.matched, "kept": self.kept,
+                "bytes_received": self.bytes_received, "bytes_written": self.bytes_written}
@@ -0,0 +1,99 @@
+import binascii
+import json
+import mmap
+import os
+
+# Raw bytes encoded per step; a multiple of 3 so the base64 chunks join without padding
+CHUNK_SIZE = 3 * 256 * 1024
+
+# MIME type used in the data URL prefix when the format cannot be recognised
+DEFAULT_MIME = 'image/jpeg'
+
+# Leading bytes of the image formats we label correctly instead of always claiming JPEG
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+
+def sniff_mime(path):
+    # Detect the real image format from the file header
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    for magic, mime in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return mime
+    return DEFAULT_MIME
+
+
+def base64_length(size):
+    return 4 * ((size + 2) // 3)
+
+
+def encode_data_url(path, mime=None):
+    # Encode a file as a "data:<mime>;base64,..." URL into a single preallocated buffer.
+    # The file is mapped rather than read, so the only full-size allocation is the encoded output.
+    # mime defaults to the format sniffed from the file header.
+    mime = mime or sniff_mime(path)
+    prefix = f"data:{mime};base64,".encode('ascii')
+    size = os.path.getsize(path)
+    buffer = bytearray(len(prefix) + base64_length(size))
+    buffer[:len(prefix)] = prefix
+    if size == 0:
+        return buffer
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        position = len(prefix)
+        try:
+            for start in range(0, size, CHUNK_SIZE):
+                chunk = binascii.b2a_base64(view[start:start + CHUNK_SIZE], newline=False)
+                buffer[position:position + len(chunk)] = chunk
+                position += len(chunk)
+        finally:
+            view.release()
+    return buffer
+
+
+class EncodedInput:
+    # An input image encoded once as a data URL, kept as bytes so it can be spliced into frames
+    # without round-tripping through a Python str
+
+    def __init__(self, path, data_url, digest=None):
+        self.path = path
+        self.data_url = data_url
+        self.digest = digest  # Content hash, when known
+
+    @classmethod
+    def from_path(cls, path, mime=None):
+        return cls(path, encode_data_url(path, mime))
+
+    def __len__(self):
+        return len(self.data_url)
+
+
+def dumps_bytes(value):
+    return json.dumps(value).encode('utf-8')
+
+
+def build_data_frame(inputs, fn_index, session_hash, session_id):
+    # Build the JSON text of the "data" message as one bytes object.
+    # Encoded inputs are spliced in verbatim (base64 needs no JSON escaping); other values go through json.
+    parts = [b'{"fn_index": ', dumps_bytes(fn_index), b', "data": [']
+    for index, value in enumerate(inputs):
+        if index:
+            parts.append(b', ')
+        if isinstance(value, EncodedInput):
+            parts.extend((b'"', value.data_url, b'"'))
+        else:
+            parts.append(dumps_bytes(value))
+    parts.extend((
+        b'], "event_data": null, "session_hash": ', dumps_bytes(session_hash),
+        b', "session_id": ', dumps_bytes(session_id),
+        b', "msg": "data"}',
+    ))
+    return b''.join(parts)
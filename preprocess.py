@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from inputcache import file_digest
+
+# Pillow is needed to resize, crop or re-encode; OpenCV only for face cropping.
+# Both are optional: without them the stage passes inputs through unchanged.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+
+# The Haar cascade detector is absent from some OpenCV builds
+if cv2 is not None and not hasattr(cv2, 'CascadeClassifier'):
+    cv2 = None
+
+# Formats the stage can re-encode to, with their file extensions
+FORMATS = {'jpeg': '.jpg', 'webp': '.webp', 'png': '.png'}
+
+# EXIF Orientation; 1 (or absent) means the pixels are already upright
+ORIENTATION_TAG = 0x0112
+
+# Fraction of the detected face size added on every side when cropping the source
+DEFAULT_FACE_MARGIN = 0.6
+
+
+class PreprocessOptions:
+    def __init__(self, max_size=None, crop_face=False, face_margin=DEFAULT_FACE_MARGIN, format=None, quality=90):
+        self.max_size = max_size        # Longest side in pixels; larger images are downscaled
+        self.crop_face = crop_face      # Crop the source image to the largest detected face
+        self.face_margin = face_margin
+        self.format = format            # 'jpeg', 'webp', 'png' or None to keep the input format
+        self.quality = quality
+
+    def enabled(self):
+        return bool(self.max_size or self.crop_face or self.format)
+
+    def key(self, role):
+        # Everything that changes the output for an input in this role
+        return json.dumps([role, self.max_size, self.crop_face and role == 'source', self.face_margin,
+                           self.format, self.quality])
+
+
+def detect_face(image):
+    # Bounding box (left, top, right, bottom) of the largest frontal face, or None
+    if cv2 is None:
+        return None
+    gray = cv2.cvtColor(numpy.asarray(image.convert('RGB')), cv2.COLOR_RGB2GRAY)
+    classifier = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    faces = classifier.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(32, 32))
+    if len(faces) == 0:
+        return None
+    x, y, width, height = max(faces, key=lambda face: face[2] * face[3])
+    return int(x), int(y), int(x + width), int(y + height)
+
+
+def preprocess_image(path, options, role, output_path):
+    # Runs in a worker process. Writes the processed image to output_path and returns it, or returns
+    # the original path when nothing needed to change (avoids a lossy round trip for no gain), or
+    # when only resizing or re-encoding was asked for and the result is not smaller.
+    with Image.open(path) as opened:
+        # exif_transpose() returns a copy even without an orientation tag, so check the tag itself
+        oriented = opened.getexif().get(ORIENTATION_TAG, 1) != 1
+        image = ImageOps.exif_transpose(opened) if oriented else opened
+        # Rotating and cropping change what the server sees; resizing and re-encoding only save bytes
+        reshaped = oriented
+        changed = oriented
+        source_format = (opened.format or '').lower()
+
+        if options.crop_face and role == 'source':
+            box = detect_face(image)
+            if box is not None:
+                left, top, right, bottom = box
+                margin_x = int((right - left) * options.face_margin)
+                margin_y = int((bottom - top) * options.face_margin)
+                image = image.crop((max(0, left - margin_x), max(0, top - margin_y),
+                                    min(image.width, right + margin_x), min(image.height, bottom + margin_y)))
+                reshaped = changed = True
+
+        if options.max_size and max(image.size) > options.max_size:
+            image = image.copy() if image is opened else image
+            image.thumbnail((options.max_size, options.max_size), Image.LANCZOS)
+            changed = True
+
+        target_format = options.format or ('jpeg' if source_format in ('jpeg', 'mpo') else
+                                           source_format if source_format in FORMATS else 'png')
+        if not changed and target_format == source_format:
+            return path
+
+        if target_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        save_options = {'quality': options.quality} if target_format in ('jpeg', 'webp') else {'optimize': True}
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        image.save(temp_path, format=target_format.upper(), **save_options)
+    if not reshaped and os.path.getsize(temp_path) >= os.path.getsize(path):
+        os.remove(temp_path)
+        return path
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+class Preprocessor:
+    # Optional client-side stage run before payload_data is built: downscale, crop the source to the
+    # face and re-encode. Work runs in a process pool so it overlaps with other jobs' network I/O.
+    # Outputs are content-addressed (input hash + options), so a repeated source is processed once
+    # and the processed file hits the input, upload and result caches like any other input.
+
+    def __init__(self, options, output_dir=None, workers=None):
+        self.options = options
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix='facefusion-preprocess-')
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.prepared = {}
+        self.pending = {}
+        self.processed = 0
+        if Image is None:
+            print("Pillow is not installed; inputs are sent without pre-processing.")
+        elif options.crop_face and cv2 is None:
+            print("OpenCV is not installed; source images are not cropped to the face.")
+
+    async def prepare(self, path, role):
+        if Image is None or not self.options.enabled():
+            return path
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, role)
+        prepared = self.prepared.get(memo_key)
+        if prepared is not None and os.path.exists(prepared):
+            return prepared
+
+        digest = await asyncio.to_thread(file_digest, path)
+        name = hashlib.sha256((digest + self.options.key(role)).encode('utf-8')).hexdigest()[:40]
+        extension = FORMATS.get(self.options.format) or os.path.splitext(path)[1] or '.img'
+        output_path = os.path.join(self.output_dir, name + extension)
+        if os.path.exists(output_path):
+            prepared = output_path
+        elif output_path in self.pending:
+            # The same input is already being processed for another job
+            prepared = await asyncio.shield(self.pending[output_path])
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, preprocess_image, path, self.options, role, output_path)
+            self.pending[output_path] = future
+            try:
+                prepared = await asyncio.shield(future)
+            finally:
+                del self.pending[output_path]
+            self.processed += 1
+        self.prepared[memo_key] = prepared
+        return prepared
+
+    def close(self):
+        self.pool.shutdown()
+
+    def stats(self):
+        return {"processed": self.processed, "prepared": len(self.prepared)}
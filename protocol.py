@@ -0,0 +1,115 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Parsing of Gradio /queue/join messages without paying for the big ones.
+# message_type() reads "msg" with a regex instead of a parse. parse_message() fully parses small
+# frames, but in large frames (process_completed carrying a base64 image) it cuts every long
+# "data:..." string out before parsing and puts a DataURL span over the original text in its
+# place, so the image is decoded straight from the frame instead of being copied into new strings.
+
+# Frames up to this many characters are parsed in full
+LARGE_MESSAGE = 64 * 1024
+
+# Data URLs shorter than this stay inline in the parsed message
+INLINE_DATA_URL = 4 * 1024
+
+MSG_PATTERN = re.compile(r'"msg"\s*:\s*"([A-Za-z_]+)"')
+
+# Stands in for a cut-out data URL while the rest of the frame is parsed
+PLACEHOLDER = '\x00data-url:'
+
+
+def loads(text):
+    # orjson when installed (several times faster on the small control messages), else json
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class DataURL:
+    # A "data:<mime>;base64,..." string as a span of the frame text it arrived in
+
+    __slots__ = ('text', 'start', 'end')
+
+    def __init__(self, text, start, end):
+        self.text = text
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def startswith(self, prefix):
+        return self.text.startswith(prefix, self.start, self.end)
+
+    def header(self):
+        # "data:image/png;base64"
+        return self.text[self.start:self.text.index(',', self.start, self.end)]
+
+    def __str__(self):
+        # Materializes the whole string; only for callers that need a real str
+        return self.text[self.start:self.end]
+
+    def __repr__(self):
+        return f"DataURL({self.header()!r}, {len(self)} chars)"
+
+
+def message_type(text):
+    # The "msg" value of a frame, or None. Gradio puts "msg" first, so this rarely scans far;
+    # base64 contains no quotes, so the pattern cannot match inside image data.
+    match = MSG_PATTERN.search(text)
+    return match.group(1) if match else None
+
+
+def restore_spans(value, spans):
+    if isinstance(value, str):
+        if value.startswith(PLACEHOLDER):
+            return spans[int(value[len(PLACEHOLDER):])]
+        return value
+    if isinstance(value, dict):
+        return {key: restore_spans(item, spans) for key, item in value.items()}
+    if isinstance(value, list):
+        return [restore_spans(item, spans) for item in value]
+    return value
+
+
+def parse_message(text):
+    # Parse a frame into a dict; long data URLs in large frames come back as DataURL spans
+    if len(text) <= LARGE_MESSAGE:
+        return loads(text)
+    pieces = []
+    spans = []
+    position = 0
+    while True:
+        # A quote followed by "data:" can only open a string value in valid JSON
+        start = text.find('"data:', position)
+        if start < 0:
+            break
+        end = text.find('"', start + 1)
+        if end < 0:
+            break
+        if end - start < INLINE_DATA_URL:
+            position = end + 1
+            continue
+        if text.find('\\', start, end) >= 0:
+            # Escaped characters need a real JSON parse
+            return loads(text)
+        pieces.append(text[position:start])
+        pieces.append(json.dumps(PLACEHOLDER + str(len(spans))))
+        spans.append(DataURL(text, start + 1, end))
+        position = end + 1
+    if not spans:
+        return loads(text)
+    pieces.append(text[position:])
+    return restore_spans(loads(''.join(pieces)), spans)
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
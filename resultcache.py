@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from inputcache import file_digest
+
+# Default size cap for stored outputs
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class ResultCache:
+    # Persistent store of fused outputs keyed by (source hash, target hash, fn_index).
+    # Outputs are copied into the cache directory and indexed in SQLite; once the stored outputs
+    # exceed max_bytes the least recently used ones are deleted.
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                source_hash TEXT NOT NULL,
+                target_hash TEXT NOT NULL,
+                fn_index INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (source_hash, target_hash, fn_index)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.db.commit()
+
+    def lookup(self, source_hash, target_hash, fn_index):
+        # Return the path of a stored output, or None
+        key = (source_hash, target_hash, fn_index)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_name FROM results WHERE source_hash = ? AND target_hash = ? AND fn_index = ?",
+                key).fetchone()
+            path = os.path.join(self.directory, row[0]) if row else None
+            if path and not os.path.isfile(path):
+                # The file was removed behind our back; drop the stale row
+                self.db.execute(
+                    "DELETE FROM results WHERE source_hash = ? AND target_hash = ? AND fn_index = ?", key)
+                self.db.commit()
+                path = None
+            if path is None:
+                self.misses += 1
+                return None
+            self.db.execute(
+                "UPDATE results SET last_access = ? WHERE source_hash = ? AND target_hash = ? AND fn_index = ?",
+                (time.time(),) + key)
+            self.db.commit()
+            self.hits += 1
+            return path
+
+    def restore(self, source_hash, target_hash, fn_index, output_path):
+        # Copy a stored output to output_path; returns False on a miss
+        path = self.lookup(source_hash, target_hash, fn_index)
+        if path is None:
+            return False
+        shutil.copyfile(path, output_path)
+        return True
+
+    def store(self, source_hash, target_hash, fn_index, output_path):
+        size = os.path.getsize(output_path)
+        if size > self.max_bytes:
+            return
+        extension = os.path.splitext(output_path)[1] or '.bin'
+        file_name = f"{source_hash[:32]}_{target_hash[:32]}_{fn_index}{extension}"
+        temp_path = os.path.join(self.directory, f"{file_name}.{threading.get_ident()}.tmp")
+        shutil.copyfile(output_path, temp_path)
+        os.replace(temp_path, os.path.join(self.directory, file_name))
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source_hash, target_hash, fn_index, file_name, size, now, now))
+            self.db.commit()
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        while total > self.max_bytes:
+            row = self.db.execute(
+                "SELECT source_hash, target_hash, fn_index, file_name, size FROM results "
+                "ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.delete_row(row)
+            total -= row[4]
+            self.evictions += 1
+        self.db.commit()
+
+    def delete_row(self, row):
+        source_hash, target_hash, fn_index, file_name = row[:4]
+        self.db.execute(
+            "DELETE FROM results WHERE source_hash = ? AND target_hash = ? AND fn_index = ?",
+            (source_hash, target_hash, fn_index))
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, source_hash=None, target_hash=None, fn_index=None):
+        # Remove every entry matching the given fields; with no fields, clear the cache
+        conditions, values = [], []
+        for column, value in (('source_hash', source_hash), ('target_hash', target_hash), ('fn_index', fn_index)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT source_hash, target_hash, fn_index, file_name, size FROM results{where}", values).fetchall()
+            for row in rows:
+                self.delete_row(row)
+            self.db.commit()
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            entries, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the fused result cache.")
+    parser.add_argument('directory', help="Result cache directory")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help="Print entry count and size")
+    subparsers.add_parser('clear', help="Remove every cached result")
+    invalidate = subparsers.add_parser('invalidate', help="Remove results matching a source and/or target")
+    invalidate.add_argument('--source', help="Source image path")
+    invalidate.add_argument('--target', help="Target image path")
+    invalidate.add_argument('--source-hash', help="Source content hash (sha256)")
+    invalidate.add_argument('--target-hash', help="Target content hash (sha256)")
+    invalidate.add_argument('--fn-index', type=int)
+    args = parser.parse_args()
+
+    cache = ResultCache(args.directory)
+    if args.command == 'stats':
+        print(json.dumps(cache.stats()))
+    elif args.command == 'clear':
+        print(f"Removed {cache.invalidate()} cached results.")
+    else:
+        source_hash = file_digest(args.source) if args.source else args.source_hash
+        target_hash = file_digest(args.target) if args.target else args.target_hash
+        if source_hash is None and target_hash is None and args.fn_index is None:
+            parser.error("invalidate needs --source, --target, their hashes or --fn-index; use clear to remove all.")
+        print(f"Removed {cache.invalidate(source_hash, target_hash, args.fn_index)} cached results.")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
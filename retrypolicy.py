@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import os
+import time
+
+from downloads import part_path_for
+from scheduler import BACKOFF_BASE, BACKOFF_CAP, backoff_delay
+
+# Attempts per job, including the first, before a retryable failure is returned
+MAX_ATTEMPTS = 3
+
+# error_types worth another attempt: the job never ran, or ran somewhere that went away
+RETRYABLE_ERRORS = {'connection', 'handshake', 'upload', 'queue_full', 'queue_timeout', 'timeout'}
+
+# Substrings of server error messages that mark a transient failure rather than a bad input
+# (for example "no face detected" is fatal, "CUDA out of memory" is not)
+TRANSIENT_MESSAGES = ('out of memory', 'cuda', 'temporarily', 'timed out', 'try again', 'overloaded',
+                      'connection reset')
+
+# Hedging: resubmit a job still running after this quantile of recent job latencies, once at least
+# HEDGE_MIN_SAMPLES jobs have finished, and hedge at most HEDGE_BUDGET of all jobs
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET = 0.1
+HEDGE_WINDOW = 500
+
+
+class RetryPolicy:
+    # Retries retryable failures with full-jitter exponential backoff (see scheduler.backoff_delay).
+    # attempt() must run the job once and return a result record; it is called again per retry, so
+    # callers acquire their concurrency slot inside it and no slot is held while backing off.
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+                 retryable=RETRYABLE_ERRORS, transient_messages=TRANSIENT_MESSAGES):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retryable = retryable
+        self.transient_messages = transient_messages
+        self.retries = 0
+        self.exhausted = 0
+        self.fatal = {}  # error_type -> count of failures not retried
+
+    def is_retryable(self, result):
+        if result['status'] in ('done', 'unauthorized'):
+            # unauthorized survives the session's own cookie refresh, so retrying will not help
+            return False
+        error_type = result.get('error_type')
+        if error_type in self.retryable:
+            return True
+        if error_type in ('server_error', 'process'):
+            message = (result.get('error') or '').lower()
+            return any(pattern in message for pattern in self.transient_messages)
+        return False
+
+    async def run(self, attempt):
+        for number in range(1, self.max_attempts + 1):
+            result = await attempt()
+            if result['status'] == 'done':
+                break
+            if not self.is_retryable(result):
+                key = result.get('error_type') or result['status']
+                self.fatal[key] = self.fatal.get(key, 0) + 1
+                break
+            if number == self.max_attempts:
+                self.exhausted += 1
+                break
+            self.retries += 1
+            await asyncio.sleep(backoff_delay(number - 1, self.backoff_base, self.backoff_cap))
+        result['attempts'] = number
+        return result
+
+    def stats(self):
+        return {"retries": self.retries, "exhausted": self.exhausted, "fatal": dict(self.fatal)}
+
+
+def hedge_path(output_path):
+    # Sibling file for the hedged attempt's output, keeping the extension
+    root, extension = os.path.splitext(output_path)
+    return f"{root}.hedge{extension}"
+
+
+class HedgedSession:
+    # Wraps a session (FusionSession or LoadBalancer) so that straggler jobs are resubmitted to a
+    # second session once they run past the HEDGE_QUANTILE of recent latencies; whichever attempt
+    # succeeds first wins and the other is cancelled. The budget bounds the extra load on the backend.
+    # Offers the same restore_cached()/fuse() interface as the session it wraps.
+
+    def __init__(self, primary, secondary=None, quantile=HEDGE_QUANTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 budget=HEDGE_BUDGET, window=HEDGE_WINDOW):
+        self.primary = primary
+        self.secondary = secondary or primary
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.latencies = collections.deque(maxlen=window)
+        self.jobs = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fn_index = primary.fn_index
+        self.input_cache = primary.input_cache
+        self.upload_refs = primary.upload_refs
+        self.result_cache = primary.result_cache
+        self.preprocessor = primary.preprocessor
+        self.transcoder = primary.transcoder
+        self.telemetry = primary.telemetry
+
+    @property
+    def bootstraps(self):
+        if self.secondary is self.primary:
+            return self.primary.bootstraps
+        return self.primary.bootstraps + self.secondary.bootstraps
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        await self.primary.start()
+        if self.secondary is not self.primary:
+            await self.secondary.start()
+
+    async def close(self):
+        await self.primary.close()
+        if self.secondary is not self.primary:
+            await self.secondary.close()
+
+    async def ensure_cookies(self):
+        await self.primary.ensure_cookies()
+        if self.secondary is not self.primary:
+            await self.secondary.ensure_cookies()
+
+    def hedge_delay(self):
+        # Seconds after which a job counts as a straggler, or None when hedging is not allowed yet
+        if len(self.latencies) < self.min_samples or self.hedges >= self.budget * self.jobs:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+    async def restore_cached(self, source, target, output_path='fused_image.png', fn_index=None):
+        return await self.primary.restore_cached(source, target, output_path, fn_index)
+
+    async def fuse(self, source, target, output_path='fused_image.png', check_cache=True, on_estimation=None,
+                   **overrides):
+        if check_cache:
+            cached = await self.restore_cached(source, target, output_path, overrides.get('fn_index'))
+            if cached is not None:
+                return cached
+
+        self.jobs += 1
+        started = time.monotonic()
+        delay = self.hedge_delay()
+        primary = asyncio.create_task(self.primary.fuse(
+            source, target, output_path, check_cache=False, on_estimation=on_estimation, **overrides))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Straggler: race a second submission against it
+                self.hedges += 1
+                tasks.add(asyncio.create_task(self.secondary.fuse(
+                    source, target, hedge_path(output_path), check_cache=False, **overrides)))
+            first_failure = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result['status'] != 'done':
+                        if first_failure is None or task is primary:
+                            first_failure = result
+                        continue
+                    if task is not primary:
+                        os.replace(hedge_path(output_path), output_path)
+                        result.update(output=output_path, hedged=True)
+                        self.hedge_wins += 1
+                    self.latencies.append(time.monotonic() - started)
+                    return result
+            return first_failure
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # The losing attempt's output, complete or partial; a finished download has no part file
+            # left, so output_path's own is only ever a cancelled primary's
+            for path in (hedge_path(output_path), part_path_for(hedge_path(output_path)), part_path_for(output_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stats(self):
+        delay = self.hedge_delay()
+        return {
+            "jobs": self.jobs,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_after": round(delay, 3) if delay is not None else None,
+        }
@@ -0,0 +1,127 @@
+import asyncio
+import random
+import time
+
+# Retries of a job the server rejected with queue_full before giving up on it
+QUEUE_FULL_RETRIES = 8
+
+# Backoff after queue_full: full jitter over an exponentially growing window, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit driven by the server's own signals.
+    # Each completed job whose last rank_eta was under target_queue_delay adds 1/limit (about +1 per
+    # round of jobs); queue_full, or a rank_eta above twice the target, multiplies the limit by
+    # decrease at most once per cooldown, so one burst of rejections does not collapse it to the floor.
+
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5, target_queue_delay=5.0, cooldown=None):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.target_queue_delay = target_queue_delay
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.process_time = None  # EWMA of observed process times
+        self.last_rank_eta = None
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.queue_full = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_estimation(self, data):
+        rank_eta = data.get('rank_eta')
+        if isinstance(rank_eta, (int, float)):
+            self.last_rank_eta = rank_eta
+            if rank_eta > 2 * self.target_queue_delay:
+                self.back_off()
+
+    def on_success(self, process_time):
+        if process_time is not None:
+            self.process_time = process_time if self.process_time is None else 0.8 * self.process_time + 0.2 * process_time
+        if self.last_rank_eta is None or self.last_rank_eta <= self.target_queue_delay:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self.increases += 1
+                self.wake()
+
+    def on_queue_full(self):
+        self.queue_full += 1
+        self.back_off()
+
+    def back_off(self):
+        # One decrease per cooldown window; by default the window is one observed process time
+        cooldown = self.cooldown if self.cooldown is not None else (self.process_time or 1.0)
+        now = time.monotonic()
+        if now - self.last_decrease < cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.decreases += 1
+
+    def wake(self):
+        # Let waiters re-check after the limit grew; safe to call from synchronous callbacks
+        async def notify():
+            async with self.condition:
+                self.condition.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "queue_full": self.queue_full,
+            "last_rank_eta": self.last_rank_eta,
+            "process_time": round(self.process_time, 4) if self.process_time is not None else None,
+        }
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Full jitter: uniform over [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveScheduler:
+    # Runs jobs under an AdaptiveLimiter and retries queue_full rejections with jittered backoff
+    # instead of dropping them. run_job(on_estimation) must return a result record.
+
+    def __init__(self, limiter=None, queue_full_retries=QUEUE_FULL_RETRIES):
+        self.limiter = limiter or AdaptiveLimiter()
+        self.queue_full_retries = queue_full_retries
+        self.retries = 0
+
+    async def submit(self, run_job):
+        for attempt in range(self.queue_full_retries + 1):
+            await self.limiter.acquire()
+            try:
+                result = await run_job(self.limiter.on_estimation)
+            finally:
+                await self.limiter.release()
+            if result['status'] != 'queue_full':
+                if result['status'] == 'done':
+                    self.limiter.on_success((result.get('timings') or {}).get('process'))
+                return result
+            self.limiter.on_queue_full()
+            if attempt < self.queue_full_retries:
+                self.retries += 1
+                await asyncio.sleep(backoff_delay(attempt))
+        return result
+
+    def stats(self):
+        return dict(self.limiter.stats(), retries=self.retries)
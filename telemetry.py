@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Per-job spans and Prometheus metrics for fusion jobs.
+# A JobTrace collects spans on the monotonic clock while a job runs; Telemetry turns finished traces
+# into Prometheus counters/histograms and, optionally, appends them to an OpenTelemetry (OTLP/JSON)
+# trace file that a collector's file receiver or any OTLP tool can read.
+
+# Histogram buckets in seconds, from sub-10ms phases up to long queue waits
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+SERVICE_NAME = 'facefusion-client'
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def otlp_attributes(attributes):
+    values = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            wrapped = {"boolValue": value}
+        elif isinstance(value, int):
+            wrapped = {"intValue": str(value)}
+        elif isinstance(value, float):
+            wrapped = {"doubleValue": value}
+        else:
+            wrapped = {"stringValue": str(value)}
+        values.append({"key": key, "value": wrapped})
+    return values
+
+
+class JobTrace:
+    # The spans of one fusion job: a root span for the whole job and a child span per phase
+    # (bootstrap, preprocess, upload, connect, send_hash, queue_wait, encode, process, download).
+
+    def __init__(self, name='fusion_job', attributes=None):
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.started = time.monotonic()
+        # Converts monotonic readings to wall-clock nanoseconds for export
+        self.epoch_offset_ns = time.time_ns() - int(self.started * 1e9)
+        self.ended = None
+        self.status = None
+        self.error_type = None
+        self.spans = []
+        self.events = []
+
+    def add_span(self, name, started, ended, **attributes):
+        self.spans.append((name, started, ended, attributes))
+
+    def add_event(self, name, **attributes):
+        self.events.append((name, time.monotonic(), attributes))
+
+    def finish(self, status, error_type=None):
+        self.ended = time.monotonic()
+        self.status = status
+        self.error_type = error_type
+
+    def phase_seconds(self):
+        # Total seconds per phase; a retried job may record the same phase more than once
+        totals = {}
+        for name, started, ended, attributes in self.spans:
+            totals[name] = totals.get(name, 0.0) + (ended - started)
+        return totals
+
+    def to_otlp(self):
+        def nanos(seconds):
+            return str(self.epoch_offset_ns + int(seconds * 1e9))
+
+        ended = self.ended if self.ended is not None else time.monotonic()
+        root = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KIND_CLIENT,
+            "startTimeUnixNano": nanos(self.started),
+            "endTimeUnixNano": nanos(ended),
+            "attributes": otlp_attributes(dict(self.attributes, status=self.status, error_type=self.error_type)),
+            "events": [{"timeUnixNano": nanos(at), "name": name, "attributes": otlp_attributes(attributes)}
+                       for name, at, attributes in self.events],
+            "status": {"code": STATUS_OK if self.status == 'done' else STATUS_ERROR},
+        }
+        if self.status != 'done':
+            root["status"]["message"] = self.status or 'unfinished'
+        spans = [root]
+        for name, started, span_ended, attributes in self.spans:
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": self.span_id,
+                "name": name,
+                "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": nanos(started),
+                "endTimeUnixNano": nanos(span_ended),
+                "attributes": otlp_attributes(attributes),
+                "status": {"code": STATUS_UNSET},
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+        }]}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=repr(float(bound))))} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(dict(labels, le="+Inf"))} {self.count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {self.total}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Telemetry:
+    # Shared by every job of a FusionSession (or every endpoint of a LoadBalancer).
+    # metrics() renders the Prometheus text format; serve() exposes it on /metrics and write_metrics()
+    # writes it for a node_exporter textfile collector, which suits short batch runs.
+
+    def __init__(self, trace_path=None, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.trace_path = trace_path
+        self.trace_file = open(trace_path, 'a') if trace_path else None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.jobs = {}  # (endpoint, status, error_type) -> count
+        self.cached = 0
+        self.coalesced = 0
+        self.estimations = 0
+        self.job_seconds = Histogram(buckets)
+        self.phase_seconds = {}  # phase -> Histogram
+        self.queue = None  # A fairqueue.FairQueue whose per-class depth and waits are exported
+        self.runner = None
+
+    def start_job(self, source, target, endpoint=None):
+        self.in_flight += 1
+        return JobTrace(attributes={"source": source, "target": target, "endpoint": endpoint})
+
+    def finish_job(self, trace, result):
+        self.in_flight -= 1
+        trace.finish(result.get('status'), result.get('error_type'))
+        key = (trace.attributes.get('endpoint') or '', trace.status or '', trace.error_type or '')
+        self.jobs[key] = self.jobs.get(key, 0) + 1
+        self.estimations += sum(1 for name, at, attributes in trace.events if name == 'estimation')
+        self.job_seconds.observe(trace.ended - trace.started)
+        for phase, seconds in trace.phase_seconds().items():
+            if phase not in self.phase_seconds:
+                self.phase_seconds[phase] = Histogram(self.buckets)
+            self.phase_seconds[phase].observe(seconds)
+        if self.trace_file is not None:
+            line = json.dumps(trace.to_otlp(), separators=(',', ':'))
+            with self.lock:
+                self.trace_file.write(line + '\n')
+
+    def record_cached(self):
+        self.cached += 1
+
+    def record_coalesced(self):
+        self.coalesced += 1
+
+    def attach_queue(self, queue):
+        self.queue = queue
+
+    def metrics(self):
+        lines = [
+            '# HELP fusion_jobs_total Fusion jobs sent to a backend, by outcome.',
+            '# TYPE fusion_jobs_total counter',
+        ]
+        for (endpoint, status, error_type), count in sorted(self.jobs.items()):
+            labels = {"endpoint": endpoint, "status": status, "error_type": error_type}
+            lines.append(f'fusion_jobs_total{format_labels(labels)} {count}')
+        lines += [
+            '# HELP fusion_cached_jobs_total Jobs served from the result cache without a backend.',
+            '# TYPE fusion_cached_jobs_total counter',
+            f'fusion_cached_jobs_total {self.cached}',
+            '# HELP fusion_coalesced_jobs_total Jobs that shared an identical in-flight job (GPU calls saved).',
+            '# TYPE fusion_coalesced_jobs_total counter',
+            f'fusion_coalesced_jobs_total {self.coalesced}',
+            '# HELP fusion_estimations_total Estimation messages received while queued.',
+            '# TYPE fusion_estimations_total counter',
+            f'fusion_estimations_total {self.estimations}',
+            '# HELP fusion_jobs_in_flight Jobs currently running.',
+            '# TYPE fusion_jobs_in_flight gauge',
+            f'fusion_jobs_in_flight {self.in_flight}',
+            '# HELP fusion_job_seconds End-to-end seconds per job.',
+            '# TYPE fusion_job_seconds histogram',
+        ]
+        lines += self.job_seconds.render('fusion_job_seconds', {})
+        lines += [
+            '# HELP fusion_phase_seconds Seconds per job spent in each phase.',
+            '# TYPE fusion_phase_seconds histogram',
+        ]
+        for phase, histogram in sorted(self.phase_seconds.items()):
+            lines += histogram.render('fusion_phase_seconds', {"phase": phase})
+        if self.queue is not None:
+            lines += self.queue_metrics(self.queue)
+        return '\n'.join(lines) + '\n'
+
+    def queue_metrics(self, queue):
+        classes = sorted(queue.class_weights)
+        lines = []
+        for name, kind, help_text, values in (
+                ('fusion_queue_depth', 'gauge', 'Jobs waiting in the client queue, by priority class.', queue.waiting),
+                ('fusion_queue_running', 'gauge', 'Jobs let through to the server, by priority class.', queue.running),
+                ('fusion_queue_promoted_total', 'counter',
+                 'Jobs let through ahead of the fair order to meet their deadline.', queue.promoted),
+                ('fusion_queue_expired_total', 'counter',
+                 'Jobs whose deadline passed while waiting in the client queue.', queue.expired)):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{format_labels({"class": job_class})} {values[job_class]}' for job_class in classes]
+        lines += [
+            '# HELP fusion_queue_wait_seconds Seconds jobs waited in the client queue, by priority class.',
+            '# TYPE fusion_queue_wait_seconds histogram',
+        ]
+        for job_class in classes:
+            lines += queue.wait_seconds[job_class].render('fusion_queue_wait_seconds', {"class": job_class})
+        return lines
+
+    def write_metrics(self, path):
+        # Write then rename so a collector never reads a partial file
+        partial = path + '.part'
+        with open(partial, 'w') as f:
+            f.write(self.metrics())
+        os.replace(partial, path)
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.metrics(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def serve(self, host='0.0.0.0', port=9464):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+    async def stop_serving(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
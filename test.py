@@ -66,13 +66,11 @@ def main():
 
     # WebSocket event handlers
     def on_message(ws, message):
-        print("Received a message:")
-        print(message)  # Raw message for debugging
         try:
             data = json.loads(message)
-            print("Parsed message data:")
-            print(json.dumps(data, indent=2))  # Pretty-print the parsed message
             msg_type = data.get('msg')
+            # Log the type and size only: frames carry multi-MB base64 images
+            print(f"Received a {msg_type} message ({len(message)} bytes).")
 
             if msg_type == 'send_hash':
                 print("Received send_hash message.")
@@ -103,9 +101,9 @@ def main():
                     "event_data": None,
                     "msg": "data"
                 }
-                print("Sending payload:")
-                print(json.dumps(payload, indent=2))
-                ws.send(json.dumps(payload))
+                frame = json.dumps(payload)
+                print(f"Sending payload ({len(frame)} bytes).")
+                ws.send(frame)
 
             elif msg_type == 'process_starts':
                 print("Process has started.")
@@ -142,10 +140,10 @@ def main():
 
             else:
                 print(f"Received unexpected message type: {msg_type}")
-                print("Full message data:", json.dumps(data, indent=2))
+                print("Message keys:", sorted(data))
 
         except json.JSONDecodeError:
-            print("Received non-JSON message:", message)
+            print(f"Received non-JSON message ({len(message)} bytes).")
 
     def on_error(ws, error):
         print("WebSocket error:", error)
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import threading
+
+import aiohttp
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def file_reference(server_path, path):
+    # The payload_data entry Gradio accepts in place of an inline data URL
+    return {"name": server_path, "data": None, "is_file": True, "orig_name": os.path.basename(path)}
+
+
+async def upload_file(http, app_url, path):
+    # POST one file to the server's multipart /upload endpoint; the body is streamed from disk
+    upload_url = f"{app_url.rstrip('/')}/upload"
+    with open(path, 'rb') as f:
+        form = aiohttp.FormData()
+        form.add_field('files', f, filename=os.path.basename(path))
+        try:
+            async with http.post(upload_url, data=form) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise UploadError(f"Error uploading {path}: {response.status} - {text}", response.status)
+                paths = await response.json(content_type=None)
+        except aiohttp.ClientError as e:
+            raise UploadError(f"Error uploading {path}: {e}") from e
+    if not isinstance(paths, list) or not paths:
+        raise UploadError(f"Unexpected /upload response for {path}: {paths!r}")
+    return paths[0]
+
+
+class UploadReferenceCache:
+    # Maps content hashes to paths already uploaded to a server, so each distinct input is uploaded
+    # once per server. Concurrent requests for the same content share a single upload.
+    # With persist_path set, the mapping is saved as JSON and reloaded on start.
+
+    def __init__(self, persist_path=None):
+        self.persist_path = persist_path
+        self.references = {}
+        self.pending = {}
+        self.uploads = 0
+        self.reuses = 0
+        self.lock = threading.Lock()
+        if persist_path and os.path.isfile(persist_path):
+            with open(persist_path) as f:
+                self.references = json.load(f)
+
+    async def get_reference(self, http, app_url, path, digest):
+        server = app_url.rstrip('/')
+        key = (server, digest)
+        while True:
+            server_path = self.references.get(server, {}).get(digest)
+            if server_path:
+                self.reuses += 1
+                return file_reference(server_path, path)
+            pending = self.pending.get(key)
+            if pending is None:
+                break
+            server_path = await asyncio.shield(pending)
+            if server_path is not None:
+                self.reuses += 1
+                return file_reference(server_path, path)
+            # The job uploading it was cancelled; the first waiter to get here uploads it instead
+
+        pending = asyncio.get_running_loop().create_future()
+        self.pending[key] = pending
+        try:
+            server_path = await upload_file(http, server, path)
+        except asyncio.CancelledError:
+            # Only this job is cancelled; None sends the other jobs waiting on the upload to retry it
+            pending.set_result(None)
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Mark the exception as retrieved in case no other job was waiting on this upload
+            pending.exception()
+            raise
+        finally:
+            del self.pending[key]
+        self.uploads += 1
+        pending.set_result(server_path)
+        self.references.setdefault(server, {})[digest] = server_path
+        if self.persist_path:
+            await asyncio.to_thread(self.write, json.dumps(self.references))
+        return file_reference(server_path, path)
+
+    def invalidate(self, app_url, digest):
+        # Forget a reference, e.g. after the server has cleaned up its temporary files
+        removed = self.references.get(app_url.rstrip('/'), {}).pop(digest, None)
+        if removed and self.persist_path:
+            self.write(json.dumps(self.references))
+        return removed is not None
+
+    def write(self, text):
+        # Replace the persisted mapping atomically; text is serialised by the caller on the event loop
+        with self.lock:
+            temp_path = f"{self.persist_path}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(text)
+            os.replace(temp_path, self.persist_path)
+
+    def stats(self):
+        return {
+            "uploads": self.uploads,
+            "reuses": self.reuses,
+            "references": sum(len(paths) for paths in self.references.values()),
+        }
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import fusionengine
+from fusionsession import FusionSession
+from payloadencoding import sniff_mime
+
+# Pillow makes duplicate detection tolerant of encoder noise; without it only identical frames match
+try:
+    from PIL import Image, ImageChops, ImageStat
+except ImportError:
+    Image = None
+
+# ffmpeg executable; override with $FFMPEG_BINARY
+FFMPEG = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# Frames decoded but not yet muxed; bounds memory and temporary disk use regardless of video length
+DEFAULT_MAX_PENDING = 32
+
+# Mean absolute difference (0-255, on a 32x32 grayscale thumbnail) under which a frame repeats the last one
+DEFAULT_DEDUPE_THRESHOLD = 0.5
+
+# Bytes read from ffmpeg's stdout per step
+READ_SIZE = 256 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def probe_video(path):
+    # Frame rate, duration and whether there is an audio stream, parsed from "ffmpeg -i" output
+    output = subprocess.run([FFMPEG, '-hide_banner', '-i', path], capture_output=True, text=True).stderr
+    fps_match = re.search(r'Video:.*?(\d+(?:\.\d+)?) (?:fps|tbr)', output)
+    duration_match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', output)
+    if fps_match is None:
+        raise ValueError(f"No video stream found in {path}.")
+    duration = None
+    if duration_match:
+        hours, minutes, seconds = duration_match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return {"fps": float(fps_match.group(1)), "duration": duration, "has_audio": 'Audio:' in output}
+
+
+def png_end(buffer):
+    # Length of the first complete PNG in buffer, or -1 if more bytes are needed.
+    # Walks the chunk headers rather than searching for IEND, which could occur inside image data.
+    if len(buffer) < len(PNG_SIGNATURE):
+        return -1
+    if not buffer.startswith(PNG_SIGNATURE):
+        raise ValueError("ffmpeg produced a frame that is not a PNG.")
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(buffer):
+        length = int.from_bytes(buffer[position:position + 4], 'big')
+        chunk_type = bytes(buffer[position + 4:position + 8])
+        position += 12 + length
+        if chunk_type == b'IEND':
+            return position if position <= len(buffer) else -1
+    return -1
+
+
+async def read_frames(video_path):
+    # Decode the video as a stream of lossless PNG frames without holding more than one in memory
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', video_path,
+        '-f', 'image2pipe', '-c:v', 'png', '-',
+        stdout=asyncio.subprocess.PIPE)
+    buffer = bytearray()
+    try:
+        while True:
+            chunk = await process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            while (end := png_end(buffer)) != -1:
+                yield bytes(buffer[:end])
+                del buffer[:end]
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+
+def thumbnail(frame_path):
+    with Image.open(frame_path) as image:
+        return image.convert('L').resize((32, 32))
+
+
+def as_png(path):
+    # The muxer reads a PNG stream, so convert fused frames the server returned in another format
+    if sniff_mime(path) == 'image/png' or Image is None:
+        return path
+    png_path = os.path.splitext(path)[0] + '.converted.png'
+    with Image.open(path) as image:
+        image.save(png_path, format='PNG')
+    os.remove(path)
+    return png_path
+
+
+def is_duplicate(previous, current, threshold):
+    # previous/current are thumbnails (with Pillow) or raw frame bytes (without); threshold None disables
+    if previous is None or threshold is None:
+        return False
+    if Image is None:
+        return previous == current
+    return ImageStat.Stat(ImageChops.difference(previous, current)).mean[0] <= threshold
+
+
+async def fuse_video(session, source_path, video_path, output_path, concurrency=4,
+                     max_pending=DEFAULT_MAX_PENDING, dedupe_threshold=DEFAULT_DEDUPE_THRESHOLD,
+                     progress_every=25, work_dir=None):
+    # Fuse source_path into every frame of video_path and write output_path with the original audio.
+    # Frames flow decoder -> bounded queue -> concurrent queue jobs -> in-order muxer; near-identical
+    # consecutive frames reuse the previous result instead of taking a GPU slot.
+    info = await asyncio.to_thread(probe_video, video_path)
+    expected_frames = int(info["duration"] * info["fps"]) if info["duration"] else None
+    work_dir = tempfile.mkdtemp(prefix='facefusion-video-', dir=work_dir)
+    stats = {"frames": 0, "fused": 0, "duplicates": 0, "failed": 0}
+    pending = asyncio.Semaphore(max_pending)
+    jobs = asyncio.Queue(maxsize=concurrency)
+    results = {}  # frame index -> future resolving to the path of the frame to mux
+    arrived = asyncio.Event()
+    started = time.monotonic()
+
+    encoder_command = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+                       '-f', 'image2pipe', '-framerate', str(info["fps"]), '-i', '-']
+    if info["has_audio"]:
+        encoder_command += ['-i', video_path, '-map', '0:v', '-map', '1:a', '-c:a', 'copy', '-shortest']
+    encoder_command += ['-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                        output_path]
+    encoder = await asyncio.create_subprocess_exec(*encoder_command, stdin=asyncio.subprocess.PIPE)
+
+    async def worker():
+        while True:
+            index, frame_path, future = await jobs.get()
+            fused_path = os.path.join(work_dir, f'fused_{index:08d}.png')
+            fused_frame = None
+            try:
+                result = await session.fuse(source_path, frame_path, fused_path)
+                if result['status'] == 'done':
+                    fused_frame = await asyncio.to_thread(as_png, fused_path)
+            except Exception:
+                # Counted as failed below like any other frame the server did not fuse
+                pass
+            if fused_frame is not None:
+                stats["fused"] += 1
+                future.set_result(fused_frame)
+            else:
+                # Keep the video complete: fall back to the original frame
+                stats["failed"] += 1
+                future.set_result(frame_path)
+            jobs.task_done()
+
+    async def decode():
+        previous_signature = None
+        previous_future = None
+        async for frame in read_frames(video_path):
+            await pending.acquire()
+            index = stats["frames"]
+            stats["frames"] += 1
+            frame_path = os.path.join(work_dir, f'frame_{index:08d}.png')
+            await asyncio.to_thread(write_bytes, frame_path, frame)
+            signature = await asyncio.to_thread(thumbnail, frame_path) if Image is not None else frame
+            if is_duplicate(previous_signature, signature, dedupe_threshold):
+                stats["duplicates"] += 1
+                results[index] = previous_future
+                arrived.set()
+                os.remove(frame_path)
+                continue
+            previous_signature = signature
+            previous_future = asyncio.get_running_loop().create_future()
+            results[index] = previous_future
+            arrived.set()
+            await jobs.put((index, frame_path, previous_future))
+        results[stats["frames"]] = None  # End of stream
+        arrived.set()
+
+    async def mux():
+        index = 0
+        last_path = None
+        while True:
+            while index not in results:
+                arrived.clear()
+                await arrived.wait()
+            future = results.pop(index)
+            if future is None:
+                break
+            path = await future
+            with open(path, 'rb') as f:
+                encoder.stdin.write(f.read())
+            await encoder.stdin.drain()
+            if last_path is not None and last_path != path:
+                remove_frame_files(last_path)
+            last_path = path
+            index += 1
+            pending.release()
+            if progress_every and index % progress_every == 0:
+                elapsed = time.monotonic() - started
+                total = f"/{expected_frames}" if expected_frames else ""
+                print(f"Frame {index}{total}: {index / elapsed:.1f} frames/s, "
+                      f"{stats['duplicates']} duplicates, {stats['failed']} failed")
+        if last_path is not None:
+            remove_frame_files(last_path)
+
+    def remove_frame_files(path):
+        # A fused frame's input is no longer needed once the frame has been muxed
+        directory, name = os.path.split(path)
+        frame_name = 'frame_' + name.split('_', 1)[1].split('.', 1)[0] + '.png'
+        for candidate in {path, os.path.join(directory, frame_name)}:
+            if os.path.exists(candidate):
+                os.remove(candidate)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(decode(), mux())
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if encoder.stdin and not encoder.stdin.is_closing():
+            encoder.stdin.close()
+        await encoder.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with status {encoder.returncode} while writing {output_path}.")
+    elapsed = time.monotonic() - started
+    return dict(stats, output=output_path, elapsed=round(elapsed, 3),
+                frames_per_second=round(stats["frames"] / elapsed, 2) if elapsed else None)
+
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuse a source face into every frame of a target video.")
+    parser.add_argument('source', help="Source face image")
+    parser.add_argument('video', help="Target video")
+    parser.add_argument('output', help="Output video")
+    parser.add_argument('--concurrency', type=int, default=4, help="Frames in flight on the server")
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING,
+                        help="Frames decoded but not yet written to the output")
+    parser.add_argument('--dedupe-threshold', type=float, default=DEFAULT_DEDUPE_THRESHOLD,
+                        help="Reuse the previous result when a frame differs less than this (0 disables)")
+    parser.add_argument('--app-url', default=fusionengine.APP_URL, help="Defaults to $APP_URL")
+    parser.add_argument('--websocket-url', default=fusionengine.WEBSOCKET_URL, help="Defaults to $WEBSOCKET_URL")
+    args = parser.parse_args()
+
+    if not args.app_url or not args.websocket_url:
+        parser.error("Set APP_URL and WEBSOCKET_URL or pass --app-url and --websocket-url.")
+    if not os.path.isfile(args.source) or not os.path.isfile(args.video):
+        parser.error("Source image and target video must exist.")
+
+    async def run():
+        async with FusionSession(args.app_url, args.websocket_url, concurrency=args.concurrency) as session:
+            return await fuse_video(session, args.source, args.video, args.output, concurrency=args.concurrency,
+                                    max_pending=max(args.max_pending, args.concurrency),
+                                    dedupe_threshold=args.dedupe_threshold if args.dedupe_threshold > 0 else None)
+
+    print(json.dumps(asyncio.run(run())))
+
+
+if __name__ == "__main__":
+    main()